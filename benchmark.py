@@ -0,0 +1,271 @@
+"""
+Benchmarks for the mapping pipeline: payload building, entry generation and
+end-to-end delivery to a local UIA Agent simulator (uia_simulator.py).
+
+    python benchmark.py --quick --output bench.json
+    python benchmark.py --output bench-1.0.1.json --compare bench-1.0.0.json
+
+Results are written as JSON (one record per case: entries/sec, p50/p99 batch
+latency, CPU time, peak memory) so runs from different releases can be diffed.
+--compare exits non-zero if any case lost more than --threshold of its throughput.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+import subprocess
+import tracemalloc
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = "benchmark"
+USER_PREFIX = "domain\\user"
+FIRST_IP = 10 << 24  # 10.0.0.0
+
+FULL_GRID = {"batch_sizes": [100, 500, 1000, 5000, 10000], "counts": [10000, 100000, 1000000],
+             "inflight": [1, 4, 8], "min_time": 0.5}
+QUICK_GRID = {"batch_sizes": [100, 500, 5000], "counts": [10000, 100000], "inflight": [1, 4], "min_time": 0.2}
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def record(suite, case, entries, wall, cpu, latencies=None, peak_kb=None, **extra):
+    result = {
+        "suite": suite,
+        "case": case,
+        "entries": entries,
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "entries_per_sec": round(entries / wall) if wall > 0 else 0,
+    }
+    if latencies is not None:
+        result["p50_ms"] = round(percentile(latencies, 50) * 1000, 3)
+        result["p99_ms"] = round(percentile(latencies, 99) * 1000, 3)
+    if peak_kb is not None:
+        result["peak_mem_kb"] = peak_kb
+    result.update(extra)
+    print(f"{suite:9} {json.dumps(case):60} {result['entries_per_sec']:>10} entries/s"
+          + (f"  p50 {result['p50_ms']}ms p99 {result['p99_ms']}ms" if latencies is not None else ""), flush=True)
+    return result
+
+def traced_peak_kb(fn):
+    """Peak Python allocation of one call, in KiB (run separately: tracing slows everything down)"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+# Payload building
+
+def bench_build(main, batch_sizes, min_time):
+    results = []
+    for size in batch_sizes:
+        entries = [{"name": f"{USER_PREFIX}{i + 1}", "ip": main._ipv4_str(FIRST_IP + i), "timeout": 3600}
+                   for i in range(size)]
+        builders = {
+            "etree": lambda: ET.tostring(main.create_uid_message(entries, "login"), encoding="utf-8", method="xml"),
+            "fast": lambda: main.serialize_uid_message(entries, "login"),
+            "range": lambda: main.serialize_uid_range(FIRST_IP, size, 4, USER_PREFIX, 1, 3600, "login"),
+        }
+        for name, build in builders.items():
+            latencies = []
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            while time.perf_counter() - wall_start < min_time or len(latencies) < 3:
+                started = time.perf_counter()
+                build()
+                latencies.append(time.perf_counter() - started)
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            results.append(record("build", {"serializer": name, "batch_size": size}, size * len(latencies),
+                                  wall, cpu, latencies, traced_peak_kb(build)))
+    return results
+
+# Entry generation, as process_mass_mapping walks a subnet
+
+def bench_generate(main, counts, batch_sizes):
+    results = []
+    for count in counts:
+        for size in batch_sizes:
+            request = main.MappingRequest(subnet="10.0.0.0/8", batch_size=size, max_count=count)
+
+            def generate():
+                network, first_ip, total = main.plan_subnet(request)
+                latencies = []
+                for offset, batch_ip, batch in main.iter_range_batches(first_ip, total, request.batch_size):
+                    started = time.perf_counter()
+                    main.build_uid_range_payload(batch_ip, batch, network.version, request.user_prefix,
+                                                 offset + 1, request.timeout, "login")
+                    latencies.append(time.perf_counter() - started)
+                return latencies
+
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            latencies = generate()
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            results.append(record("generate", {"count": count, "batch_size": size}, count, wall, cpu,
+                                  latencies, traced_peak_kb(generate)))
+    return results
+
+# End-to-end delivery
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_simulator(port, args):
+    cmd = [sys.executable, os.path.join(HERE, "uia_simulator.py"), "--port", str(port), "--cert-dir", "certs",
+           "--password", PASSWORD, "--stats-interval", "0"] + args
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("UIA Agent simulator did not start")
+
+async def deliver(main, url, count, batch_size, inflight):
+    dispatcher = main.AgentDispatcher([url], "broadcast", inflight, "none", None)
+    latencies = []
+    # Timed per send attempt by the window, not from submit: waiting for a free slot is not batch latency
+    attempted = lambda count, latency, ok: latencies.append(latency)
+    for offset, batch_ip, size in main.iter_range_batches(FIRST_IP + 1, count, batch_size):
+        await dispatcher.submit_range(batch_ip, size, 4, USER_PREFIX, offset + 1, 3600, "login", on_attempt=attempted)
+    await dispatcher.drain()
+    return latencies, dispatcher.stats[url]
+
+def deliver_case(url, count, batch_size, inflight):
+    """One deliver case in a fresh process: ru_maxrss never shrinks, so only then is it this case's peak"""
+    import main
+    main.logger.setLevel("WARNING")
+    asyncio.run(deliver(main, url, 1000, 500, 1))  # Warm up: handshake, SSL context cache
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    latencies, stats = asyncio.run(deliver(main, url, count, batch_size, inflight))
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    return latencies, stats, wall, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_deliver(counts, batch_sizes, inflights, simulator_args):
+    port = free_port()
+    proc = start_simulator(port, simulator_args)
+    url = f"127.0.0.1:{port}"
+    results = []
+    try:
+        for count in counts:
+            for size in batch_sizes:
+                for inflight in inflights:
+                    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                        latencies, stats, wall, cpu, peak_rss = pool.submit(deliver_case, url, count, size,
+                                                                            inflight).result()
+                    results.append(record("deliver", {"count": count, "batch_size": size, "max_inflight": inflight},
+                                          stats["acked"], wall, cpu, latencies, peak_rss_kb=peak_rss,
+                                          failed=stats["failed"], retries=stats["retries"]))
+    finally:
+        proc.terminate()
+        proc.wait()
+    return results
+
+# Comparison
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {(r["suite"], json.dumps(r["case"], sort_keys=True)): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get((r["suite"], json.dumps(r["case"], sort_keys=True)))
+        if not old or not old["entries_per_sec"]:
+            continue
+        change = r["entries_per_sec"] / old["entries_per_sec"] - 1
+        if change < -threshold:
+            regressions.append((r, old, change))
+            print(f"REGRESSION {r['suite']} {json.dumps(r['case'])}: "
+                  f"{old['entries_per_sec']} -> {r['entries_per_sec']} entries/s ({change:+.0%})")
+    print(f"{len(regressions)} regression(s) against {baseline_path}")
+    return regressions
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the UIA mapping pipeline")
+    parser.add_argument("--suites", default="build,generate,deliver", help="Comma-separated: build, generate, deliver")
+    parser.add_argument("--batch-sizes", type=int_list)
+    parser.add_argument("--counts", type=int_list)
+    parser.add_argument("--inflight", type=int_list, help="max_inflight values for deliver")
+    parser.add_argument("--min-time", type=float, help="Seconds each build case runs for")
+    parser.add_argument("--quick", action="store_true", help="Small default grid for a fast smoke run")
+    parser.add_argument("--simulator-args", default="", help="Extra uia_simulator.py options, e.g. '--latency 5'")
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--compare", help="Baseline results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Throughput drop that counts as a regression")
+    args = parser.parse_args(argv)
+    for name, default in (QUICK_GRID if args.quick else FULL_GRID).items():
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+    return args
+
+def main():
+    args = parse_args()
+    suites = set(args.suites.split(","))
+    # Work in a scratch directory with its own PKI so runs never touch real certs or job data
+    workdir = tempfile.mkdtemp(prefix="uia-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("DATA_DIR", os.path.join(workdir, "data"))
+    sys.path.insert(0, HERE)
+    import main as app
+    app.logger.setLevel("WARNING")
+    asyncio.run(app.generate_pki(app.GeneratePKIRequest(password=PASSWORD)))
+
+    results = []
+    if "build" in suites:
+        results += bench_build(app, args.batch_sizes, args.min_time)
+    if "generate" in suites:
+        results += bench_generate(app, args.counts, args.batch_sizes)
+    if "deliver" in suites:
+        results += bench_deliver(args.counts, args.batch_sizes, args.inflight, args.simulator_args.split())
+
+    with open(os.path.join(HERE, "VERSION")) as f:
+        version = f.read().strip()
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {
+        "meta": {
+            "version": version,
+            "commit": commit,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "fast_xml": app.FAST_XML,
+            "simulator_args": args.simulator_args,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(os.path.join(HERE, args.output) if not os.path.isabs(args.output) else args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        baseline = args.compare if os.path.isabs(args.compare) else os.path.join(HERE, args.compare)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
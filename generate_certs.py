@@ -1,13 +1,16 @@
 import os
+import argparse
 import datetime
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
 from cryptography.hazmat.primitives.serialization import pkcs12
 
-def generate_key():
+def generate_key(key_type="rsa"):
+    if key_type == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1())
     return rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048,
@@ -26,9 +29,9 @@ def save_cert(cert, filename):
     with open(filename, "wb") as f:
         f.write(cert.public_bytes(serialization.Encoding.PEM))
 
-def generate_ca():
+def generate_ca(key_type="rsa"):
     print("Generating Root CA...")
-    key = generate_key()
+    key = generate_key(key_type)
     subject = issuer = x509.Name([
         x509.NameAttribute(NameOID.COUNTRY_NAME, u"US"),
         x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u"California"),
@@ -54,9 +57,9 @@ def generate_ca():
     
     return key, cert
 
-def generate_signed_cert(ca_key, ca_cert, common_name, is_server=True):
+def generate_signed_cert(ca_key, ca_cert, common_name, is_server=True, key_type="rsa"):
     print(f"Generating {'Server' if is_server else 'Client'} Cert: {common_name}...")
-    key = generate_key()
+    key = generate_key(key_type)
     subject = x509.Name([
         x509.NameAttribute(NameOID.COUNTRY_NAME, u"US"),
         x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, u"California"),
@@ -83,7 +86,7 @@ def generate_signed_cert(ca_key, ca_cert, common_name, is_server=True):
             x509.KeyUsage(
                 digital_signature=True,
                 content_commitment=False,
-                key_encipherment=True,
+                key_encipherment=key_type == "rsa",  # EC keys only sign (ECDHE)
                 data_encipherment=False,
                 key_agreement=False,
                 key_cert_sign=False,
@@ -105,6 +108,10 @@ def generate_signed_cert(ca_key, ca_cert, common_name, is_server=True):
     return key, cert
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate a Root CA, UIA Agent server cert and app client cert")
+    parser.add_argument("--key-type", choices=["rsa", "ecdsa"], default="rsa",
+                        help="rsa: 2048-bit RSA keys; ecdsa: P-256 keys, cheaper mTLS handshakes")
+    args = parser.parse_args()
     cert_dir = "certs"
     if not os.path.exists(cert_dir):
         os.makedirs(cert_dir)
@@ -115,12 +122,13 @@ def main():
         print(f"No password entered, using default: {pfx_password}")
 
     # 1. Root CA
-    ca_key, ca_cert = generate_ca()
+    ca_key, ca_cert = generate_ca(args.key_type)
     save_key(ca_key, os.path.join(cert_dir, "rootCA.key"))
     save_cert(ca_cert, os.path.join(cert_dir, "rootCA.crt"))
 
     # 2. UIA Server Cert (for Windows)
-    uia_key, uia_cert = generate_signed_cert(ca_key, ca_cert, u"uia-server", is_server=True)
+    uia_key, uia_cert = generate_signed_cert(ca_key, ca_cert, u"uia-server", is_server=True,
+                                             key_type=args.key_type)
     save_key(uia_key, os.path.join(cert_dir, "uia-server.key"))
     save_cert(uia_cert, os.path.join(cert_dir, "uia-server.crt"))
     
@@ -147,7 +155,8 @@ def main():
         f.write(ca_cert.public_bytes(serialization.Encoding.PEM)) # Include CA in bundle
 
     # 3. App Client Cert (for Python/Docker)
-    app_key, app_cert = generate_signed_cert(ca_key, ca_cert, u"uia-client-app", is_server=False)
+    app_key, app_cert = generate_signed_cert(ca_key, ca_cert, u"uia-client-app", is_server=False,
+                                             key_type=args.key_type)
     save_key(app_key, os.path.join(cert_dir, "uia-client.key"))
     save_cert(app_cert, os.path.join(cert_dir, "uia-client.crt"))
     
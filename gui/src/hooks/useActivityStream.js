@@ -0,0 +1,41 @@
+import { useState, useEffect } from 'react';
+import axios from 'axios';
+
+const API_BASE = 'http://localhost:8000';
+const MAX_LINES = 50;
+
+// Log lines (newest first) and job progress, pushed by the backend over /events.
+// Falls back to polling /get-logs?since= where EventSource is not available.
+export default function useActivityStream() {
+    const [logs, setLogs] = useState([]);
+    const [progress, setProgress] = useState({ current: 0, total: 0, running: false });
+
+    useEffect(() => {
+        const addLines = lines => {
+            if (lines.length) setLogs(prev => [...lines.reverse(), ...prev].slice(0, MAX_LINES));
+        };
+
+        if (typeof EventSource !== 'undefined') {
+            const source = new EventSource(`${API_BASE}/events`);
+            source.addEventListener('log', e => addLines(JSON.parse(e.data)));
+            source.addEventListener('progress', e => setProgress(JSON.parse(e.data)));
+            return () => source.close();
+        }
+
+        let since = 0;
+        const interval = setInterval(async () => {
+            try {
+                const [logRes, progressRes] = await Promise.all([
+                    axios.get(`${API_BASE}/get-logs`, { params: { since } }),
+                    axios.get(`${API_BASE}/progress`)
+                ]);
+                since = logRes.data.seq;
+                addLines(logRes.data.logs || []);
+                setProgress(progressRes.data);
+            } catch (e) { }
+        }, 2000);
+        return () => clearInterval(interval);
+    }, []);
+
+    return [logs, progress, setProgress];
+}
@@ -1,13 +1,13 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState } from 'react';
 import axios from 'axios';
 import { ShieldCheck } from 'lucide-react';
 import LogPanel from '../components/LogPanel';
+import useActivityStream from '../hooks/useActivityStream';
 
 const API_BASE = 'http://localhost:8000';
 
 export default function DUGManager({ uiaUrl }) {
-    const [logs, setLogs] = useState([]);
-    const [progress, setProgress] = useState({ current: 0, total: 0, running: false });
+    const [logs, progress] = useActivityStream();
 
     // Single entry
     const [singleUser, setSingleUser] = useState('domain\\testuser');
@@ -17,20 +17,6 @@ export default function DUGManager({ uiaUrl }) {
     const [bulkUsers, setBulkUsers] = useState('');
     const [bulkTag, setBulkTag] = useState('Finance');
 
-    useEffect(() => {
-        const interval = setInterval(async () => {
-            try {
-                const [logRes, progressRes] = await Promise.all([
-                    axios.get(`${API_BASE}/get-logs`),
-                    axios.get(`${API_BASE}/progress`)
-                ]);
-                setLogs(logRes.data.logs?.reverse() || []);
-                setProgress(progressRes.data);
-            } catch (e) { }
-        }, 2000);
-        return () => clearInterval(interval);
-    }, []);
-
     const handleSingle = async (action) => {
         try {
             await axios.post(`${API_BASE}/update-tags`, {
@@ -2,13 +2,13 @@ import React, { useState, useEffect } from 'react';
 import axios from 'axios';
 import { Network } from 'lucide-react';
 import LogPanel from '../components/LogPanel';
+import useActivityStream from '../hooks/useActivityStream';
 
 const API_BASE = 'http://localhost:8000';
 const STORAGE_KEY = 'uia_ipmapping_form';
 
 export default function IPMapping({ uiaUrl }) {
-    const [logs, setLogs] = useState([]);
-    const [progress, setProgress] = useState({ current: 0, total: 0, running: false });
+    const [logs, progress, setProgress] = useActivityStream();
 
     // Load from localStorage on mount
     const loadSaved = () => {
@@ -37,21 +37,6 @@ export default function IPMapping({ uiaUrl }) {
         localStorage.setItem(STORAGE_KEY, JSON.stringify({ single: singleForm, bulk: bulkForm }));
     }, [singleForm, bulkForm]);
 
-    // Poll progress and logs
-    useEffect(() => {
-        const interval = setInterval(async () => {
-            try {
-                const [logRes, progressRes] = await Promise.all([
-                    axios.get(`${API_BASE}/get-logs`),
-                    axios.get(`${API_BASE}/progress`)
-                ]);
-                setLogs(logRes.data.logs?.reverse() || []);
-                setProgress(progressRes.data);
-            } catch (e) { }
-        }, 2000);
-        return () => clearInterval(interval);
-    }, []);
-
     const handleSingleMapping = async (operation) => {
         try {
             await axios.post(`${API_BASE}/single-mapping`, {
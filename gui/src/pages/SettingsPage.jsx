@@ -2,14 +2,16 @@ import React, { useState, useEffect } from 'react';
 import axios from 'axios';
 import { Settings, Shield, Upload, Download, CheckCircle, XCircle } from 'lucide-react';
 import LogPanel from '../components/LogPanel';
+import useActivityStream from '../hooks/useActivityStream';
 
 const API_BASE = 'http://localhost:8000';
 
 export default function SettingsPage({ uiaUrl, onUrlChange }) {
-    const [logs, setLogs] = useState([]);
+    const [logs] = useActivityStream();
     const [certStatus, setCertStatus] = useState({ has_certs: false });
     const [loading, setLoading] = useState(false);
     const [password, setPassword] = useState('changeme');
+    const [keyType, setKeyType] = useState('rsa');
     const [settingsUrl, setSettingsUrl] = useState(uiaUrl);
     const [testResult, setTestResult] = useState(null);
 
@@ -20,13 +22,6 @@ export default function SettingsPage({ uiaUrl, onUrlChange }) {
 
     useEffect(() => {
         checkCertStatus();
-        const interval = setInterval(async () => {
-            try {
-                const logRes = await axios.get(`${API_BASE}/get-logs`);
-                setLogs(logRes.data.logs?.reverse() || []);
-            } catch { }
-        }, 2000);
-        return () => clearInterval(interval);
     }, []);
 
     const checkCertStatus = async () => {
@@ -39,7 +34,7 @@ export default function SettingsPage({ uiaUrl, onUrlChange }) {
     const handleGeneratePKI = async () => {
         setLoading(true);
         try {
-            await axios.post(`${API_BASE}/generate-pki`, { password });
+            await axios.post(`${API_BASE}/generate-pki`, { password, key_type: keyType });
             await checkCertStatus();
             alert(`PKI Generated!\n\nPassword: ${password}\n\nDownload rootCA.crt and uia-server-bundle.pem below.`);
         } catch (e) {
@@ -142,6 +137,13 @@ export default function SettingsPage({ uiaUrl, onUrlChange }) {
                             placeholder="changeme"
                         />
                     </div>
+                    <div>
+                        <label style={labelStyle}>Key Type</label>
+                        <select style={inputStyle} value={keyType} onChange={e => setKeyType(e.target.value)}>
+                            <option value="rsa">RSA 2048</option>
+                            <option value="ecdsa">ECDSA P-256 (faster handshakes)</option>
+                        </select>
+                    </div>
                     <button
                         style={{ ...btnGreen, opacity: loading ? 0.7 : 1 }}
                         onClick={handleGeneratePKI}
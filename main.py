@@ -1,29 +1,76 @@
 import os
+import re
 import ssl
+import time
+import socket
 import logging
 import asyncio
-import http.client
 import ipaddress
 import collections
 import threading
+import functools
+import heapq
+import itertools
+import contextlib
+import zlib
+import uuid
+import json
+import random
+import csv
+import sqlite3
+import fcntl
+import glob
+import mmap
+import struct
+import hashlib
+import multiprocessing
+import concurrent.futures
 import xml.etree.ElementTree as ET
 from datetime import datetime
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from xml.dom import minidom
 
 # Thread-safe log buffer for GUI
-log_buffer = collections.deque(maxlen=50) # Reduced from 200
+log_buffer = collections.deque(maxlen=50) # Reduced from 200; (seq, line) pairs
 buffer_lock = threading.Lock()
+log_seq = 0  # Sequence number of the newest line
+log_waiters = set()  # (loop, asyncio.Event) of connected /events streams
+log_outbox = None  # Lines waiting to be copied to the shared state store; a deque once one is in use
 
 class LogBufferHandler(logging.Handler):
     def emit(self, record):
+        global log_seq
         log_entry = self.format(record)
         with buffer_lock:
-            log_buffer.append(log_entry)
+            log_seq += 1
+            log_buffer.append((log_seq, log_entry))
+            if log_outbox is not None:
+                log_outbox.append(log_entry)
+            waiters = list(log_waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # Loop already closed
+
+def logs_since(since: int):
+    """Lines newer than since, oldest first, and the newest sequence number"""
+    if state_store.shared:
+        return state_store.logs_since(since)
+    with buffer_lock:
+        if since > log_seq:
+            since = 0  # Counted before a restart (e.g. an EventSource's Last-Event-ID): start over
+        lines = []
+        for seq, line in reversed(log_buffer):
+            if seq <= since:
+                break
+            lines.append(line)
+        return lines[::-1], log_seq
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -38,15 +85,11 @@ logging.getLogger().addHandler(buffer_handler) # Catch logs from other modules t
 app = FastAPI(title="UIA Integration API")
 
 # Global state
-stop_event = asyncio.Event()
-mapping_in_progress = False
 configured_uia_url = "127.0.0.1:5006"
 config_verified = False
-active_mapping_task = None  # Track active background task
 
-# Progress tracking
-progress_current = 0
-progress_total = 0
+# Registered agent groups: name -> AgentGroupRequest
+agent_groups = {}
 
 # Enable CORS for local development
 app.add_middleware(
@@ -56,27 +99,201 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+DEFAULT_MAX_INFLIGHT = int(os.environ.get("DEFAULT_MAX_INFLIGHT", "4"))  # Default batch window per job
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "4"))  # Jobs beyond this wait in the queue
+JOB_HISTORY = int(os.environ.get("JOB_HISTORY", "50"))  # Finished jobs kept for /jobs
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+JOURNAL_PATH = os.environ.get("JOURNAL_PATH", os.path.join(DATA_DIR, "jobs.journal"))
+JOURNAL_FSYNC_EVERY = int(os.environ.get("JOURNAL_FSYNC_EVERY", "50"))  # Checkpoints buffered before an fsync
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get("JOURNAL_FSYNC_INTERVAL", "1.0"))  # ...or seconds, whichever first
+RESUME_JOBS_ON_STARTUP = os.environ.get("RESUME_JOBS_ON_STARTUP", "0") == "1"
+DEAD_LETTER_PATH = os.environ.get("DEAD_LETTER_PATH", os.path.join(DATA_DIR, "dead-letter.ndjson"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "3"))  # Sends per batch, including the first
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))  # Seconds before the first retry, doubled each time
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "10"))
+RATE_MODE = os.environ.get("RATE_MODE", "aimd")  # "aimd", "fixed" or "none"
+RATE_INITIAL = float(os.environ.get("RATE_INITIAL", "1000"))  # Entries/sec an AIMD job starts at
+RATE_TARGET_LATENCY = float(os.environ.get("RATE_TARGET_LATENCY", "2.0"))  # Batch latency (s) AIMD backs off above
+TAG_BATCH_SIZE = int(os.environ.get("TAG_BATCH_SIZE", "500"))  # Tag entries per DAG/DUG message
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(DATA_DIR, "uploads"))  # Streamed uploads are spooled here
+SINGLE_BATCH = os.environ.get("SINGLE_BATCH", "0") == "1"  # Coalesce concurrent /single-mapping calls by default
+SINGLE_BATCH_WINDOW_MS = float(os.environ.get("SINGLE_BATCH_WINDOW_MS", "20"))  # How long a coalesced batch stays open
+SINGLE_BATCH_MAX = int(os.environ.get("SINGLE_BATCH_MAX", "500"))  # Entries that flush a coalesced batch early
+MAPPING_STATE_MAX = int(os.environ.get("MAPPING_STATE_MAX", "1000000"))  # Mappings remembered per agent; 0 disables
+REFRESH_ENABLED = os.environ.get("REFRESH_ENABLED", "0") == "1"  # Keep known mappings alive from startup
+REFRESH_MARGIN = float(os.environ.get("REFRESH_MARGIN", "60"))  # Seconds before expiry a mapping is resent at the latest
+REFRESH_SPREAD = float(os.environ.get("REFRESH_SPREAD", "0.25"))  # Fraction of the timeout refreshes are spread over
+REFRESH_BATCH_SIZE = int(os.environ.get("REFRESH_BATCH_SIZE", "500"))
+REFRESH_TICK = float(os.environ.get("REFRESH_TICK", "1.0"))  # Seconds between scheduler passes
+STREAM_PROGRESS_INTERVAL = float(os.environ.get("STREAM_PROGRESS_INTERVAL", "0.5"))  # Max progress event rate on /events
+STREAM_MIN_INTERVAL = float(os.environ.get("STREAM_MIN_INTERVAL", "0.1"))  # Log lines written within this go out together
+STREAM_KEEPALIVE = float(os.environ.get("STREAM_KEEPALIVE", "15"))  # Idle seconds before a keepalive comment
+AUTO_BATCH = os.environ.get("AUTO_BATCH", "0") == "1"  # Tune bulk/subnet batch sizes to the agent by default
+AUTO_BATCH_MIN = int(os.environ.get("AUTO_BATCH_MIN", "100"))  # Smallest batch size the tuner tries
+AUTO_BATCH_MAX = int(os.environ.get("AUTO_BATCH_MAX", "10000"))  # Largest batch size the tuner tries
+AUTO_BATCH_SAMPLES = int(os.environ.get("AUTO_BATCH_SAMPLES", "4"))  # Sends measured per batch size before comparing
+AUTO_BATCH_EXPLORE_EVERY = int(os.environ.get("AUTO_BATCH_EXPLORE_EVERY", "50"))  # Batches between tries of a neighbour size
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", "0"))  # Processes building bulk/subnet payloads; 0 builds on the event loop
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", "16"))  # Batches built ahead of the sender per job
+PAYLOAD_CACHE_MB = int(os.environ.get("PAYLOAD_CACHE_MB", "0"))  # Disk kept for built bulk/subnet payloads; 0 disables
+PAYLOAD_CACHE_DIR = os.environ.get("PAYLOAD_CACHE_DIR", os.path.join(DATA_DIR, "payload-cache"))
+PAYLOAD_CACHE_SEGMENT_MB = int(os.environ.get("PAYLOAD_CACHE_SEGMENT_MB", "64"))  # Size of a segment file, the unit of eviction
+WORKERS = int(os.environ.get("WORKERS", "1"))  # uvicorn worker processes when run as python main.py
+RUN_ID = os.environ.setdefault("UIA_RUN_ID", uuid.uuid4().hex[:12])  # Inherited by the workers of this start
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite" if WORKERS > 1 else "memory")  # Where jobs, logs and config are shared
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", os.path.join(DATA_DIR, "state.db"))
+STATE_SYNC_INTERVAL = float(os.environ.get("STATE_SYNC_INTERVAL", "0.25"))  # Seconds between publishes to the shared state
+STATE_STALE_AFTER = float(os.environ.get("STATE_STALE_AFTER", "10"))  # Seconds without a heartbeat before a worker is gone
+SUBNET_MAX_ENTRIES = int(os.environ.get("SUBNET_MAX_ENTRIES", str(2 ** 24)))  # Larger subnets need an explicit max_count
+
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SERIALIZE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+def _label_str(labels) -> str:
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+def _value_str(value) -> str:
+    # Exact rendering: ":g" would round byte counters past 1e6 to six significant digits
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Metrics:
+    """Minimal Prometheus text-format registry: labelled counters and histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, buckets)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [per-bucket counts..., sum, count]
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help, None)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, buckets)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self, gauges=()) -> str:
+        """Exposition text; gauges are (name, help, [(labels dict, value), ...]) sampled at scrape time"""
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(series) for key, series in self._histograms.items()}
+        for name, (kind, help, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (series_name, labels), value in counters.items():
+                    if series_name == name:
+                        lines.append(f"{name}{_label_str(labels)} {_value_str(value)}")
+                continue
+            for (series_name, labels), series in histograms.items():
+                if series_name != name:
+                    continue
+                for bound, count in zip(buckets, series):
+                    lines.append(f"{name}_bucket{_label_str(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{name}_bucket{_label_str(labels + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{name}_sum{_label_str(labels)} {_value_str(series[-2])}")
+                lines.append(f"{name}_count{_label_str(labels)} {series[-1]}")
+        for name, help, samples in gauges:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_label_str(tuple(sorted(labels.items())))} {_value_str(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("uia_requests_total", "Requests sent to UIA Agents, by outcome (ok or error class)")
+metrics.counter("uia_request_bytes_total", "Payload bytes sent to UIA Agents")
+metrics.counter("uia_entries_acked_total", "Entries acknowledged by UIA Agents")
+metrics.counter("uia_batch_retries_total", "Batch resends after a failed attempt")
+metrics.counter("uia_batches_dead_lettered_total", "Batches that failed every attempt")
+metrics.counter("uia_entries_rejected_total", "Entries a UIA Agent rejected individually in an otherwise accepted batch")
+metrics.histogram("uia_request_duration_seconds", "Round trip of one payload to a UIA Agent")
+metrics.histogram("uia_connect_duration_seconds", "Connection setup to a UIA Agent, by phase (tcp connect, tls handshake)")
+metrics.histogram("uia_serialize_duration_seconds", "Time to serialize one payload", SERIALIZE_BUCKETS)
+metrics.histogram("uia_pipeline_build_seconds", "Time a pipeline worker process spent building one batch", SERIALIZE_BUCKETS)
+metrics.counter("uia_payload_cache_total", "Payload cache lookups by result (hit, miss)")
+metrics.counter("uia_pipeline_wait_seconds_total", "Time a pipeline stage waited on the other (producer: queue full, sender: queue empty)")
+
 # Models
 class MappingRequest(BaseModel):
     subnet: str
     user_prefix: str = "domain\\user"
     timeout: int = 3600
     batch_size: int = 500
-    uia_url: str  # e.g., "10.254.254.127:5006"
+    uia_url: Optional[str] = None  # e.g., "10.254.254.127:5006"
+    agent_group: Optional[str] = None  # Registered agent group; used instead of uia_url
     cert_path: str = "certs/uia-client-bundle.pem"
     operation: str = "login" # "login" or "logout"
+    max_inflight: int = DEFAULT_MAX_INFLIGHT  # Batches in flight to the agent at once
+    rate_mode: str = RATE_MODE  # "aimd", "fixed" or "none"
+    rate_limit: Optional[float] = None  # Entries/sec: target for "fixed", ceiling for "aimd"
+    max_attempts: int = RETRY_MAX_ATTEMPTS  # Sends per batch before it goes to the dead-letter file
+    start_offset: int = 0  # Hosts to skip, e.g. to resume an interrupted run
+    max_count: Optional[int] = None  # Cap on entries sent; required above SUBNET_MAX_ENTRIES hosts
+    auto_batch: bool = AUTO_BATCH  # Tune batch_size to the agent while the job runs; batch_size is the starting point
 
 class TagRequest(BaseModel):
     items: List[dict] # [{"user": "...", "tag": "..."}]
     action: str # "register-user" or "unregister-user"
-    uia_url: str
+    uia_url: Optional[str] = None
+    agent_group: Optional[str] = None
     cert_path: str = "certs/uia-client-bundle.pem"
+    batch_size: int = TAG_BATCH_SIZE  # Larger lists run as a background job in batches of this size
 
 class IpTagRequest(BaseModel):
     items: List[dict] # [{"ip": "...", "tag": "..."}]
     action: str # "register" or "unregister"
-    uia_url: str
+    uia_url: Optional[str] = None
+    agent_group: Optional[str] = None
+    cert_path: str = "certs/uia-client-bundle.pem"
+    batch_size: int = TAG_BATCH_SIZE  # Larger lists run as a background job in batches of this size
+
+class TagJobRequest(BaseModel):
+    target: str  # "ip" (DAG) or "user" (DUG)
+    action: str
+    source: str  # Spooled NDJSON/CSV file under UPLOAD_DIR
+    format: str = "ndjson"  # "ndjson" or "csv"
+    tag: Optional[str] = None  # Used for rows that carry no tag of their own
+    uia_url: Optional[str] = None
+    agent_group: Optional[str] = None
     cert_path: str = "certs/uia-client-bundle.pem"
+    batch_size: int = TAG_BATCH_SIZE
+    max_inflight: int = DEFAULT_MAX_INFLIGHT
+    rate_mode: str = RATE_MODE
+    rate_limit: Optional[float] = None
+    max_attempts: int = RETRY_MAX_ATTEMPTS
+    start_offset: int = 0  # Rows to skip, e.g. to resume an interrupted run
 
 class SingleMappingRequest(BaseModel):
     ip: str
@@ -84,6 +301,7 @@ class SingleMappingRequest(BaseModel):
     timeout: int = 3600
     operation: str = "login"  # "login" or "logout"
     uia_url: str
+    coalesce: Optional[bool] = None  # Share a payload with concurrent calls; defaults to SINGLE_BATCH
 
 class BulkMappingRequest(BaseModel):
     count: int  # Total number of entries
@@ -91,9 +309,52 @@ class BulkMappingRequest(BaseModel):
     base_ip: str = "10.0.0.1"  # Starting IP
     timeout: int = 3600
     operation: str = "login"
-    uia_url: str
+    uia_url: Optional[str] = None
+    agent_group: Optional[str] = None
+    start_offset: int = 0  # Entries to skip, e.g. to resume an interrupted run
+    max_inflight: int = DEFAULT_MAX_INFLIGHT  # Batches in flight to the agent at once
+    rate_mode: str = RATE_MODE  # "aimd", "fixed" or "none"
+    rate_limit: Optional[float] = None  # Entries/sec: target for "fixed", ceiling for "aimd"
+    max_attempts: int = RETRY_MAX_ATTEMPTS  # Sends per batch before it goes to the dead-letter file
+    batch_size: int = 500
+    auto_batch: bool = AUTO_BATCH  # Tune batch_size to the agent while the job runs; batch_size is the starting point
+
+class MappingImportRequest(BaseModel):
+    source: str  # Spooled NDJSON/CSV file under UPLOAD_DIR
+    format: str = "ndjson"  # "ndjson" or "csv"
+    operation: str = "login"  # "login" or "logout"
+    timeout: int = 3600  # Used for rows that carry no timeout of their own
+    uia_url: Optional[str] = None
+    agent_group: Optional[str] = None
+    cert_path: str = "certs/uia-client-bundle.pem"
+    batch_size: int = 500
+    max_inflight: int = DEFAULT_MAX_INFLIGHT
+    rate_mode: str = RATE_MODE
+    rate_limit: Optional[float] = None
+    max_attempts: int = RETRY_MAX_ATTEMPTS
+    start_offset: int = 0  # Valid rows to skip, e.g. to resume an interrupted run
+
+class MappingSyncRequest(BaseModel):
+    source: Optional[str] = None  # Spooled desired set; None logs out every known mapping
+    format: str = "ndjson"  # "ndjson" or "csv"
+    timeout: int = 3600  # Used for rows that carry no timeout of their own
+    prune: bool = True  # Log out known mappings missing from the desired set
+    refresh_margin: int = 300  # Resend unchanged mappings that expire within this many seconds
+    uia_url: Optional[str] = None
+    agent_group: Optional[str] = None
+    cert_path: str = "certs/uia-client-bundle.pem"
+    batch_size: int = 500
+    max_inflight: int = DEFAULT_MAX_INFLIGHT
+    rate_mode: str = RATE_MODE
+    rate_limit: Optional[float] = None
+    max_attempts: int = RETRY_MAX_ATTEMPTS
+
+class AgentGroupRequest(BaseModel):
+    name: str
+    agents: List[str]  # ["10.254.254.127:5006", "10.254.254.128:5006"]
+    mode: str = "broadcast"  # "broadcast" (every agent gets everything) or "shard" (split by IP)
 
-INTERNAL_BATCH_SIZE = 500  # Fixed internal batch size
+INTERNAL_BATCH_SIZE = 500  # Default batch size for imports and syncs
 
 # UIA Communication Logic
 def create_uid_message(entries: List[dict], event_type: str = 'login'):
@@ -136,41 +397,423 @@ def create_ip_tag_message(entries: List[dict], action: str = 'register'):
         
     return uid_message
 
-def sync_send_payload(xml_str, cert_file, key_file, ca_file, hostname, port):
-    # Create SSL context with broader TLS support for older UIA Agents
-    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_REQUIRED
-    
-    # Allow older TLS versions for compatibility with legacy UIA Agents
-    context.minimum_version = ssl.TLSVersion.TLSv1
-    context.maximum_version = ssl.TLSVersion.TLSv1_3
-    
-    # Disable strict security checks for legacy compatibility
-    context.options &= ~ssl.OP_NO_SSLv3  # Clear any default restrictions
-    if hasattr(ssl, 'OP_LEGACY_SERVER_CONNECT'):
-        context.options |= ssl.OP_LEGACY_SERVER_CONNECT
-    
-    context.load_verify_locations(cafile=ca_file)
-    context.load_cert_chain(certfile=cert_file, keyfile=key_file)
-    
-    conn = http.client.HTTPSConnection(hostname, port=int(port), context=context, timeout=10)
+# Fast uid-message serialization
+# Writes payloads straight to bytes instead of building an Element tree per batch.
+# Output is byte-identical to ET.tostring(..., encoding='utf-8'); set FAST_XML=0 to use ElementTree.
+FAST_XML = os.environ.get("FAST_XML", "1") != "0"
+
+_ATTR_SPECIAL = re.compile(r'[&<>"\r\n\t]')
+_ATTR_ESCAPES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"),
+                 ("\r", "&#13;"), ("\n", "&#10;"), ("\t", "&#09;"))
+_TEXT_SPECIAL = re.compile(r'[&<>]')
+_TEXT_ESCAPES = _ATTR_ESCAPES[:3]
+_MESSAGE_HEAD = '<uid-message><version>1.0</version><type>update</type><payload>'
+_MESSAGE_TAIL = '</payload></uid-message>'
+
+def _escape_attr(value: str) -> str:
+    if _ATTR_SPECIAL.search(value) is None:
+        return value
+    for char, entity in _ATTR_ESCAPES:
+        value = value.replace(char, entity)
+    return value
+
+def _escape_text(value: str) -> str:
+    if _TEXT_SPECIAL.search(value) is None:
+        return value
+    for char, entity in _TEXT_ESCAPES:
+        value = value.replace(char, entity)
+    return value
+
+def _wrap_message(action: str, parts: List[str]) -> bytes:
+    if not parts:
+        return f'{_MESSAGE_HEAD}<{action} />{_MESSAGE_TAIL}'.encode()
+    return f'{_MESSAGE_HEAD}<{action}>{"".join(parts)}</{action}>{_MESSAGE_TAIL}'.encode()
+
+def _member(tag: str) -> str:
+    return f'<member>{_escape_text(tag)}</member>' if tag else '<member />'
+
+def serialize_uid_message(entries: List[dict], event_type: str = 'login') -> bytes:
+    return _wrap_message(event_type, [
+        f'<entry name="{_escape_attr(e["name"])}" ip="{_escape_attr(e["ip"])}" timeout="{_escape_attr(str(e["timeout"]))}" />'
+        for e in entries
+    ])
+
+def serialize_tag_message(entries: List[dict], action: str = 'register-user') -> bytes:
+    return _wrap_message(action, [
+        f'<entry user="{_escape_attr(e["user"])}"><tag>{_member(e["tag"])}</tag></entry>'
+        for e in entries
+    ])
+
+def serialize_ip_tag_message(entries: List[dict], action: str = 'register') -> bytes:
+    return _wrap_message(action, [
+        f'<entry ip="{_escape_attr(e["ip"])}"><tag>{_member(e["tag"])}</tag></entry>'
+        for e in entries
+    ])
+
+def build_uid_payload(entries: List[dict], event_type: str = 'login') -> bytes:
+    with metrics.timer("uia_serialize_duration_seconds", kind="uid"):
+        if FAST_XML:
+            return serialize_uid_message(entries, event_type)
+        return ET.tostring(create_uid_message(entries, event_type), encoding='utf-8', method='xml')
+
+def build_tag_payload(entries: List[dict], action: str = 'register-user') -> bytes:
+    with metrics.timer("uia_serialize_duration_seconds", kind="user-tag"):
+        if FAST_XML:
+            return serialize_tag_message(entries, action)
+        return ET.tostring(create_tag_message(entries, action), encoding='utf-8', method='xml')
+
+def build_ip_tag_payload(entries: List[dict], action: str = 'register') -> bytes:
+    with metrics.timer("uia_serialize_duration_seconds", kind="ip-tag"):
+        if FAST_XML:
+            return serialize_ip_tag_message(entries, action)
+        return ET.tostring(create_ip_tag_message(entries, action), encoding='utf-8', method='xml')
+
+def _ipv4_str(value: int) -> str:
+    return f"{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}"
+
+def _ipv6_str(value: int) -> str:
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+def serialize_uid_range(first_ip: int, size: int, version: int, user_prefix: str,
+                        user_start: int, timeout, event_type: str = 'login', step: int = 1) -> bytes:
+    """uid-message for size IPs (as ints, step apart) mapped to user_prefix + running number"""
+    ip_str = _ipv4_str if version == 4 else _ipv6_str
+    prefix = _escape_attr(user_prefix)
+    timeout = _escape_attr(str(timeout))
+    return _wrap_message(event_type, [
+        f'<entry name="{prefix}{user_start + k}" ip="{ip_str(first_ip + k)}" timeout="{timeout}" />'
+        for k in range(0, size * step, step)
+    ])
+
+def build_uid_range_payload(first_ip: int, size: int, version: int, user_prefix: str,
+                            user_start: int, timeout, event_type: str = 'login', step: int = 1) -> bytes:
+    if FAST_XML:
+        with metrics.timer("uia_serialize_duration_seconds", kind="uid"):
+            return serialize_uid_range(first_ip, size, version, user_prefix, user_start, timeout, event_type, step)
+    entries = [{
+        "name": f"{user_prefix}{user_start + k}",
+        "ip": str(ipaddress.ip_address(first_ip + k) if version == 4 else ipaddress.IPv6Address(first_ip + k)),
+        "timeout": timeout
+    } for k in range(0, size * step, step)]
+    return build_uid_payload(entries, event_type)
+
+# mTLS connection pooling
+# Env-tunable so bulk runs against slow legacy agents can keep more sockets warm.
+UIA_POOL_SIZE = int(os.environ.get("UIA_POOL_SIZE", "4"))  # Idle connections kept per agent
+UIA_POOL_IDLE_TIMEOUT = float(os.environ.get("UIA_POOL_IDLE_TIMEOUT", "30"))  # Seconds before an idle connection is evicted
+UIA_PIPELINE_DEPTH = int(os.environ.get("UIA_PIPELINE_DEPTH", "1"))  # Requests in flight per connection (1 = plain keep-alive)
+UIA_REQUEST_TIMEOUT = float(os.environ.get("UIA_REQUEST_TIMEOUT", "10"))  # Seconds per connect and per request
+
+_ssl_context_cache = {}
+_ssl_context_lock = threading.Lock()
+
+def get_ssl_context(cert_file, key_file, ca_file):
+    """Build (or reuse) the client SSL context for a cert set"""
+    # mtimes are part of the key so a cert swapped outside the API still gets picked up
+    key = (cert_file, key_file, ca_file,
+           os.path.getmtime(cert_file), os.path.getmtime(key_file), os.path.getmtime(ca_file))
+    with _ssl_context_lock:
+        context = _ssl_context_cache.get(key)
+        if context is not None:
+            return context
+
+        # Create SSL context with broader TLS support for older UIA Agents
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_REQUIRED
+
+        # Allow older TLS versions for compatibility with legacy UIA Agents
+        context.minimum_version = ssl.TLSVersion.TLSv1
+        context.maximum_version = ssl.TLSVersion.TLSv1_3
+
+        # Disable strict security checks for legacy compatibility
+        context.options &= ~ssl.OP_NO_SSLv3  # Clear any default restrictions
+        if hasattr(ssl, 'OP_LEGACY_SERVER_CONNECT'):
+            context.options |= ssl.OP_LEGACY_SERVER_CONNECT
+
+        context.load_verify_locations(cafile=ca_file)
+        context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+
+        # Drop contexts built from older versions of the same files
+        for stale in [k for k in _ssl_context_cache if k[:3] == key[:3]]:
+            del _ssl_context_cache[stale]
+        _ssl_context_cache[key] = context
+        return context
+
+def invalidate_ssl_contexts():
+    """Forget cached SSL contexts and pooled connections after certs are rewritten"""
+    with _ssl_context_lock:
+        _ssl_context_cache.clear()
+    connection_pool.clear()
+
+class UIAConnection:
+    """Keep-alive HTTP/1.1 over mTLS connection to a UIA Agent, driven by the event loop"""
+
+    def __init__(self, reader, writer, host_header):
+        self.reader = reader
+        self.writer = writer
+        self.host_header = host_header
+        self.loop = asyncio.get_running_loop()
+        self.last_used = time.monotonic()
+        self.requests_sent = 0
+        self.closed = False
+        self._pending = collections.deque()  # Response futures, in request order
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def open(cls, hostname, port, context, timeout):
+        reader, writer = await asyncio.wait_for(cls._connect(hostname, port, context), timeout=timeout)
+        return cls(reader, writer, f"{hostname}:{port}")
+
+    @staticmethod
+    async def _connect(hostname, port, context):
+        # TCP and TLS separately, so handshake cost (key type, session reuse) shows apart from network latency
+        agent = f"{hostname}:{port}"
+        with metrics.timer("uia_connect_duration_seconds", agent=agent, phase="tcp"):
+            reader, writer = await asyncio.open_connection(hostname, int(port))
+        try:
+            with metrics.timer("uia_connect_duration_seconds", agent=agent, phase="tls"):
+                await writer.start_tls(context, server_hostname=hostname)
+        except BaseException:
+            writer.transport.abort()
+            raise
+        return reader, writer
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def is_healthy(self, idle_timeout):
+        if self.closed or self.writer.transport.is_closing():
+            return False
+        if self.loop is not asyncio.get_running_loop():
+            return False
+        return bool(self._pending) or time.monotonic() - self.last_used <= idle_timeout
+
+    def abort(self):
+        self.closed = True
+        if self.loop.is_closed():
+            return  # Left over from a previous event loop; nothing to tear down
+        self.writer.transport.abort()
+
+    async def request(self, body: bytes, timeout: float):
+        head = (f"POST / HTTP/1.1\r\nHost: {self.host_header}\r\nAccept-Encoding: identity\r\n"
+                f"Content-Type: application/xml\r\nContent-Length: {len(body)}\r\n\r\n").encode('ascii')
+        fut = self.loop.create_future()
+        # Writes are queued in order, so pipelined responses line up with _pending
+        self._pending.append(fut)
+        self.writer.writelines([head, body])
+        self.requests_sent += 1
+        try:
+            return await asyncio.wait_for(self._drain_and_wait(fut), timeout=timeout)
+        except BaseException:
+            # Timed out or cancelled mid-request: the stream position is unknown, drop the connection
+            self.abort()
+            raise
+        finally:
+            self.last_used = time.monotonic()
+
+    async def _drain_and_wait(self, fut):
+        await self.writer.drain()
+        return await fut
+
+    async def _read_responses(self):
+        error = None
+        try:
+            while True:
+                status_line = await self.reader.readline()
+                if not status_line or not self._pending:
+                    break  # Agent closed the connection, or sent data nobody asked for
+                response = await self._read_response(status_line)
+                fut = self._pending.popleft()
+                if not fut.done():
+                    fut.set_result(response)
+                if response.pop("close"):
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            self.closed = True
+            self.writer.close()
+            while self._pending:
+                fut = self._pending.popleft()
+                if not fut.done():
+                    fut.set_exception(error or ConnectionResetError("UIA Agent closed the connection"))
+
+    async def _read_response(self, status_line):
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise ConnectionError(f"Malformed status line from UIA Agent: {status_line!r}")
+        version, status = parts[0], int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+        if status < 200 or status in (204, 304):
+            body = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await self._read_chunked()
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()  # No framing: body runs to EOF
+            close = True
+        return {"status": status, "reason": reason, "body": body.decode(errors='replace'), "close": close}
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                # Skip trailers
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+class UIAConnectionPool:
+    """Keep-alive mTLS connections keyed by agent address and cert set"""
+
+    def __init__(self, max_idle=UIA_POOL_SIZE, idle_timeout=UIA_POOL_IDLE_TIMEOUT,
+                 pipeline_depth=UIA_PIPELINE_DEPTH):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.pipeline_depth = max(1, pipeline_depth)
+        self._conns = {}  # key -> list of UIAConnection
+
+    async def acquire(self, key, hostname, port, context, timeout):
+        conns = self._conns.setdefault(key, [])
+        for conn in [c for c in conns if not c.is_healthy(self.idle_timeout)]:
+            conns.remove(conn)
+            conn.abort()
+        available = [c for c in conns if c.in_flight < self.pipeline_depth]
+        if available:
+            return min(available, key=lambda c: c.in_flight)
+        conn = await UIAConnection.open(hostname, port, context, timeout)
+        conns.append(conn)
+        return conn
+
+    def release(self, key, conn):
+        conns = self._conns.get(key, [])
+        if conn.closed:
+            if conn in conns:
+                conns.remove(conn)
+            return
+        idle = [c for c in conns if c.in_flight == 0]
+        if conn.in_flight == 0 and len(idle) > self.max_idle:
+            conns.remove(conn)
+            conn.abort()
+
+    async def send(self, key, hostname, port, context, body: bytes, timeout: float):
+        for attempt in range(2):
+            conn = await self.acquire(key, hostname, port, context, timeout)
+            reused = conn.requests_sent > 0
+            try:
+                return await conn.request(body, timeout)
+            except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                # A pooled socket can die while idle; retry once on a fresh one
+                if reused and attempt == 0:
+                    continue
+                raise
+            finally:
+                self.release(key, conn)
+
+    def clear(self):
+        for conns in self._conns.values():
+            for conn in conns:
+                conn.abort()
+        self._conns.clear()
+
+connection_pool = UIAConnectionPool()
+
+# Agent response classification
+# Accepted batches are recognised from the root tag alone; only error responses are parsed.
+_ROOT_TAG = re.compile(r'<([A-Za-z][\w.:-]*)([^>]*)>')
+_ERROR_STATUS = re.compile(r'\sstatus\s*=\s*["\']error["\']')
+ENTRY_KEYS = ("ip", "name", "user")  # Attributes that identify an entry in uid-message payloads
+
+def classify_response(body: str) -> Optional[dict]:
+    """None if the agent accepted the whole batch, else {"message", "rejected": [entry, ...]}
+
+    Entries the agent names in the error payload are returned as {"action", "ip"/"name"/"user",
+    "message"}; an error that names no entries rejects the whole batch.
+    """
+    root_tag = _ROOT_TAG.search(body) if body else None
+    if root_tag is None or not _ERROR_STATUS.search(root_tag.group(2)):
+        return None
     try:
-        headers = {'Content-Type': 'application/xml'}
-        conn.request('POST', '', body=xml_str, headers=headers)
-        response = conn.getresponse()
-        data = response.read().decode()
-        return {"status": response.status, "reason": response.reason, "body": data}
-    finally:
-        conn.close()
+        root = ET.fromstring(body)
+    except ET.ParseError:
+        return {"message": body[:500], "rejected": []}
+    rejected = []
+    for payload in root.iter("payload"):
+        for action in payload:
+            for entry in action.iter("entry"):
+                record = {"action": action.tag}
+                record.update((key, entry.get(key)) for key in ENTRY_KEYS if entry.get(key) is not None)
+                record["message"] = entry.get("message") or " ".join("".join(entry.itertext()).split())
+                rejected.append(record)
+    node = root.find(".//result")
+    if node is None:
+        node = root.find(".//msg")
+    message = " ".join("".join(node.itertext()).split()) if node is not None else body[:500]
+    return {"message": message or "status=error", "rejected": rejected}
+
+def _entry_identity(attrs) -> frozenset:
+    return frozenset((key, attrs[key]) for key in ENTRY_KEYS if attrs.get(key) is not None)
 
-async def send_payload_async(xml_str: str, cert_path: str, uia_url: str):
+def select_payload_entries(payload, rejected: List[dict]):
+    """Copy of a uid-message with only the rejected entries left; returns (payload bytes, entry count)"""
+    root = ET.fromstring(payload)
+    wanted = {}  # action -> identities
+    for record in rejected:
+        wanted.setdefault(record.get("action"), []).append(_entry_identity(record))
+    count = 0
+    for payload_node in root.iter("payload"):
+        for action in list(payload_node):
+            identities = wanted.get(action.tag, ())
+            for entry in list(action):
+                identity = _entry_identity(entry.attrib)
+                if any(key and key <= identity for key in identities):
+                    count += 1
+                else:
+                    action.remove(entry)
+            if len(action) == 0:
+                payload_node.remove(action)
+    return ET.tostring(root, encoding="utf-8", method="xml"), count
+
+def rejected_ips(result: dict) -> set:
+    return {int(ipaddress.ip_address(record["ip"])) for record in result.get("rejected", ()) if "ip" in record}
+
+async def send_payload_async(payload, cert_path: str, uia_url: str):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    started = time.perf_counter()
+    result = await _deliver_payload(payload, cert_path, uia_url)
+    metrics.observe("uia_request_duration_seconds", time.perf_counter() - started, agent=uia_url)
+    outcome = result.get("error_class") or ("partial" if result.get("rejected") else "ok")
+    metrics.inc("uia_requests_total", agent=uia_url, outcome=outcome)
+    metrics.inc("uia_request_bytes_total", len(payload), agent=uia_url)
+    if result.get("rejected"):
+        metrics.inc("uia_entries_rejected_total", len(result["rejected"]), agent=uia_url)
+    return result
+
+async def _deliver_payload(payload, cert_path: str, uia_url: str):
     try:
         if ':' not in uia_url:
-            return {"error": f"Invalid URL format: {uia_url}. Use host:port"}
+            return {"error": f"Invalid URL format: {uia_url}. Use host:port", "error_class": "config"}
         hostname, port = uia_url.split(':')
     except Exception as e:
-        return {"error": f"URL Parse Error: {e}"}
+        return {"error": f"URL Parse Error: {e}", "error_class": "config"}
 
     ca_file = os.path.abspath("certs/rootCA.crt")
     cert_file = os.path.abspath("certs/uia-client.crt")
@@ -178,43 +821,39 @@ async def send_payload_async(xml_str: str, cert_path: str, uia_url: str):
     
     if not all(os.path.exists(f) for f in [ca_file, cert_file, key_file]):
         missing = [f for f in [ca_file, cert_file, key_file] if not os.path.exists(f)]
-        return {"error": f"Missing cert files: {missing}"}
+        return {"error": f"Missing cert files: {missing}", "error_class": "config"}
 
     try:
-        # Run blocking HTTP call in a thread to keep the event loop alive
-        result = await asyncio.to_thread(sync_send_payload, xml_str, cert_file, key_file, ca_file, hostname, port)
+        context = get_ssl_context(cert_file, key_file, ca_file)
+        body = payload.encode() if isinstance(payload, str) else payload
+        key = (hostname, int(port), cert_file, key_file, ca_file)
+        result = await connection_pool.send(key, hostname, port, context, body, UIA_REQUEST_TIMEOUT)
         
-        # Check XML for internal agent errors
-        if "body" in result:
-            try:
-                root = ET.fromstring(result["body"])
-                status_attr = root.get('status')
-                if status_attr == 'error':
-                    error_msg = result["body"]
-                    result_node = root.find('.//result')
-                    if result_node is not None:
-                         error_msg = result_node.text
-                    return {"error": f"UIA Agent Error: {error_msg}"}
-            except:
-                pass 
+        # Agent errors: whole batch, or only the entries it names (those are not worth retrying as-is)
+        failure = classify_response(result.get("body", ""))
+        if failure and failure["rejected"]:
+            logger.warning(f"{uia_url} rejected {len(failure['rejected'])} entries: {failure['rejected'][0]['message']}")
+            return dict(result, rejected=failure["rejected"])
+        if failure:
+            return {"error": f"UIA Agent Error: {failure['message']}", "error_class": "agent"}
                 
         if result.get("status", 0) >= 400:
-             return {"error": f"HTTP {result['status']}: {result['reason']}"}
+             error_class = "http_5xx" if result["status"] >= 500 else "http_4xx"
+             return {"error": f"HTTP {result['status']}: {result['reason']}", "error_class": error_class}
              
         return result
     except ssl.SSLError as e:
         logger.error(f"SSL handshake failed for {uia_url}: {e}")
-        return {"error": f"SSL Error (Check UIA Server Cert/Root CA): {e.reason if hasattr(e, 'reason') else e}"}
+        return {"error": f"SSL Error (Check UIA Server Cert/Root CA): {e.reason if hasattr(e, 'reason') else e}", "error_class": "tls"}
     except (ConnectionRefusedError, ConnectionResetError) as e:
         logger.error(f"Network connection failed for {uia_url}: {e}")
-        return {"error": f"Connection Error: Ensure the UIA Service is RUNNING on {hostname}:{port}"}
+        return {"error": f"Connection Error: Ensure the UIA Service is RUNNING on {hostname}:{port}", "error_class": "transport"}
+    except asyncio.TimeoutError:
+        logger.error(f"Timed out waiting for {uia_url}")
+        return {"error": f"Timeout: No response from {hostname}:{port} within {UIA_REQUEST_TIMEOUT:g}s", "error_class": "timeout"}
     except Exception as e:
-        error_str = str(e)
-        # Ignore if this is actually a valid response (false positive)
-        if "<uid-response" in error_str or "uid-response" in error_str:
-            return {"status": 200, "body": error_str}  # It's actually a success
         logger.error(f"Error during payload delivery to {uia_url}: {e}")
-        return {"error": f"Delivery Error: {error_str}"}
+        return {"error": f"Delivery Error: {e}", "error_class": "transport"}
 
 async def test_uia_connection(uia_url: str):
     """3-Stage verification: TCP -> mTLS Handshake -> XML Version Check"""
@@ -245,209 +884,2528 @@ async def test_uia_connection(uia_url: str):
     logger.info("Stage 2 SUCCESS: Agent responded correctly.")
     return {"message": "Verification Successful"}
 
+# Single-mapping coalescing
+
+class SingleMappingBatcher:
+    """Coalesces concurrent single mappings per agent and operation into one payload"""
+
+    def __init__(self, window: float, max_entries: int):
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self._pending = {}  # (uia_url, operation) -> {"entries", "futures", "timer"}
+        self._tasks = set()
+
+    async def send(self, uia_url: str, operation: str, entry: dict):
+        """Queue one entry; returns the result of the shared batch it went out in"""
+        loop = asyncio.get_running_loop()
+        key = (uia_url, operation)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {"entries": [], "futures": [],
+                                          "timer": loop.call_later(self.window, self._flush, key)}
+        future = loop.create_future()
+        batch["entries"].append(entry)
+        batch["futures"].append(future)
+        if len(batch["entries"]) >= self.max_entries:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        task = asyncio.create_task(self._deliver(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, key, batch):
+        uia_url, operation = key
+        entries = batch["entries"]
+        try:
+            result = await send_payload_async(build_uid_payload(entries, operation), "", uia_url)
+            result = dict(result, batched=len(entries))
+        except Exception as e:
+            result = {"error": f"Delivery Error: {e}", "error_class": "transport", "batched": len(entries)}
+        if len(entries) > 1:
+            logger.info(f"Coalesced {len(entries)} single {operation}s to {uia_url}")
+        rejected = {_entry_identity(record): record for record in result.get("rejected", ())}
+        accepted = {k: v for k, v in result.items() if k != "rejected"}  # The batch's other rejections aren't this caller's
+        for entry, future in zip(entries, batch["futures"]):
+            if future.done():  # The caller may have gone away
+                continue
+            identity = _entry_identity(entry)
+            record = next((record for key, record in rejected.items() if key <= identity), None)
+            if record:
+                future.set_result({"error": f"UIA Agent rejected entry: {record['message']}", "error_class": "agent",
+                                   "batched": len(entries)})
+            else:
+                future.set_result(accepted)
+
+single_batcher = SingleMappingBatcher(SINGLE_BATCH_WINDOW_MS / 1000, SINGLE_BATCH_MAX)
+
+# Rate Control
+
+class RateController:
+    """Paces entries sent to the agent; subclasses decide how the rate moves"""
+
+    def __init__(self, rate: Optional[float]):
+        self.rate = rate  # Entries/sec, None = unlimited
+        self._next_send = 0.0
+
+    async def acquire(self, count: int):
+        # Virtual scheduling: each batch reserves count/rate seconds of send time
+        if not self.rate:
+            return
+        now = time.monotonic()
+        start = max(now, self._next_send)
+        self._next_send = start + count / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def record(self, count: int, latency: float, ok: bool):
+        pass
+
+class TokenBucketController(RateController):
+    """Fixed target rate"""
+
+class AIMDController(RateController):
+    """Additive increase while the agent keeps up, multiplicative decrease on errors or slow replies"""
+
+    def __init__(self, initial_rate: float = RATE_INITIAL, max_rate: Optional[float] = None,
+                 min_rate: float = 50.0, target_latency: float = RATE_TARGET_LATENCY,
+                 increase: float = 250.0, decrease: float = 0.5):
+        super().__init__(min(initial_rate, max_rate) if max_rate else initial_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self._last_decrease = 0.0
+
+    def record(self, count: int, latency: float, ok: bool):
+        now = time.monotonic()
+        if ok and latency <= self.target_latency:
+            self.rate += self.increase
+            if self.max_rate:
+                self.rate = min(self.rate, self.max_rate)
+        elif now - self._last_decrease > self.target_latency:
+            # Batches already in flight report the same congestion; back off once per episode
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._last_decrease = now
+            logger.warning(f"Agent {'slow' if ok else 'error'} ({latency:.2f}s), backing off to {self.rate:.0f} entries/s")
+
+def make_rate_controller(mode: str, rate_limit: Optional[float] = None) -> RateController:
+    """Build the controller for a job; rate_limit is the target (fixed) or the ceiling (aimd)"""
+    if mode == "aimd":
+        return AIMDController(max_rate=rate_limit)
+    if mode == "fixed":
+        if not rate_limit:
+            raise ValueError("rate_mode 'fixed' requires rate_limit")
+        return TokenBucketController(rate_limit)
+    if mode == "none":
+        return RateController(None)
+    raise ValueError(f"Unknown rate_mode: {mode}. Use aimd, fixed or none")
+
+# Batch Size Tuning
+class BatchSizeTuner:
+    """Hill-climbs the batch size towards the best acknowledged entries/sec under the latency and error ceilings
+
+    Each send is scored as entries/sec (entries over send latency, 0 if it failed). The tuner first climbs
+    from the starting size in doubling steps while the score keeps improving, then keeps trying a neighbour
+    size every explore_every batches so it follows the agent as its sweet spot moves.
+    """
+
+    def __init__(self, initial: int, min_size: int = AUTO_BATCH_MIN, max_size: int = AUTO_BATCH_MAX,
+                 target_latency: float = RATE_TARGET_LATENCY, samples: int = AUTO_BATCH_SAMPLES,
+                 explore_every: int = AUTO_BATCH_EXPLORE_EVERY, max_error_rate: float = 0.1,
+                 margin: float = 0.05, job_id: str = ""):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.size = min(self.max_size, max(self.min_size, initial))
+        self.target_latency = target_latency
+        self.samples = max(1, samples)
+        self.explore_every = max(1, explore_every)
+        self.max_error_rate = max_error_rate
+        self.margin = margin  # A neighbour must beat the current size by this fraction to replace it
+        self.job_id = job_id
+        self.probing = True  # Climbing from the start size; afterwards only periodic neighbour trials
+        self.trial = None  # Neighbour size being measured
+        self._direction = 1
+        self._turned = False  # Probing already tried the other direction
+        self._trial_left = 0  # Trial batches still to hand out
+        self._trial_seen = 0  # Trial sends measured so far
+        self._since_trial = 0
+        self._stats = {}  # size -> recent (entries/sec, latency, ok) samples
+        self._handed = {self.size}  # Sizes given out; a shorter final batch is not a sample of anything
+
+    def next_size(self) -> int:
+        """Batch size for the next batch; called once per batch by the producer"""
+        if self.trial is None:
+            self._since_trial += 1
+            # Only once the current size has its own measurements to compare against
+            measured = len(self._stats.get(self.size, ())) >= self.samples
+            if measured and (self.probing or self._since_trial >= self.explore_every):
+                self._start_trial()
+        if self.trial is not None and self._trial_left > 0:
+            self._trial_left -= 1
+            self._handed.add(self.trial)
+            return self.trial
+        return self.size
+
+    def _start_trial(self):
+        trial = self._neighbour(self._direction)
+        if trial == self.size:
+            self._direction = -self._direction
+            trial = self._neighbour(self._direction)
+        if trial == self.size:
+            self.probing = False
+            return
+        self.trial = trial
+        self._trial_left = self.samples
+        self._trial_seen = 0
+
+    def _neighbour(self, direction: int) -> int:
+        size = self.size * 2 if direction > 0 else self.size // 2
+        return min(self.max_size, max(self.min_size, size))
+
+    def _score(self, size: int):
+        """(median entries/sec, within ceilings) over the recent samples of one size"""
+        samples = self._stats.get(size, ())
+        if not samples:
+            return 0.0, False
+        rates = sorted(rate for rate, _, _ in samples)
+        latencies = sorted(latency for _, latency, _ in samples)
+        errors = sum(1 for _, _, ok in samples if not ok)
+        ok = latencies[len(latencies) // 2] <= self.target_latency and errors <= self.max_error_rate * len(samples)
+        return rates[len(rates) // 2], ok
+
+    def record(self, size: int, count: int, latency: float, ok: bool):
+        """One send of a batch handed out at size: count entries (this agent's part) in latency seconds"""
+        if size not in self._handed:
+            return
+        samples = self._stats.setdefault(size, collections.deque(maxlen=self.samples * 2))
+        samples.append((count / latency if ok and latency > 0 else 0.0, latency, ok))
+        if size == self.trial:
+            self._trial_seen += 1
+            if self._trial_seen >= self.samples:
+                self._finish_trial()
+        elif size == self.size and self.trial is None and self.size > self.min_size:
+            # Over a ceiling at the current size: try a smaller one now instead of waiting for the next trial
+            if len(samples) >= self.samples and not self._score(size)[1]:
+                self._direction = -1
+                self._since_trial = self.explore_every
+
+    def _finish_trial(self):
+        current, current_ok = self._score(self.size)
+        trial, trial_ok = self._score(self.trial)
+        better = trial_ok and (trial > current * (1 + self.margin) or not current_ok)
+        if not better and not current_ok and self.trial < self.size:
+            better = True  # Smaller batches are the only way back under the ceiling
+        if better:
+            logger.info(f"[{self.job_id}] Batch size {self.size} -> {self.trial} "
+                        f"({trial:.0f} vs {current:.0f} entries/s per send)")
+            self.size = self.trial
+        elif self.probing and not self._turned:
+            self._direction = -self._direction
+            self._turned = True
+        elif self.probing:
+            self.probing = False
+            logger.info(f"[{self.job_id}] Batch size settled at {self.size} ({current:.0f} entries/s per send)")
+        else:
+            self._direction = -self._direction
+        if better and self.probing:
+            self._turned = True  # Keep climbing this way; the other side is worse by construction
+        self.trial = None
+        self._since_trial = 0
+
+    def to_dict(self):
+        return {
+            "batch_size": self.size,
+            "probing": self.probing,
+            "trial": self.trial,
+            "scores": {size: round(self._score(size)[0]) for size in sorted(self._stats)},
+        }
+
+# Delivery Retries
+RETRYABLE_ERRORS = {"transport", "timeout", "http_5xx", "agent"}
+
+class RetryPolicy:
+    """Exponential backoff with jitter for batches that fail with a retryable error class"""
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, result: dict, attempt: int) -> bool:
+        return attempt < self.max_attempts and result.get("error_class") in RETRYABLE_ERRORS
+
+    def delay(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+async def send_with_retry(policy: RetryPolicy, send, *args, on_attempt=None):
+    """Call send(*args) until it succeeds or the policy gives up; the result carries the attempt count"""
+    attempt = 1
+    while True:
+        started = time.monotonic()
+        result = await send(*args)
+        if on_attempt:
+            on_attempt(time.monotonic() - started, "error" not in result)
+        if "error" not in result or not policy.should_retry(result, attempt):
+            result["attempts"] = attempt
+            return result
+        delay = policy.delay(attempt)
+        logger.warning(f"Send failed ({result['error']}), retry {attempt}/{policy.max_attempts - 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+class DeadLetterStore:
+    """NDJSON file of batches that failed every attempt, kept for replay
+
+    Every worker shares the file: changes are made under an flock of path + ".lock", and a replay moves its
+    records to a claim file it keeps flocked until it is done, so no two workers send the same batch. A claim
+    file nobody holds a lock on was left by a worker that died mid-replay; its records go back to the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Released when the file is closed
+            yield
+
+    def add(self, job_id: str, url: str, cert_path: str, count: int, payload, result: dict):
+        record = {
+            "id": uuid.uuid4().hex[:12],
+            "job": job_id,
+            "agent": url,
+            "cert_path": cert_path,
+            "count": count,
+            "error": result["error"],
+            "error_class": result.get("error_class"),
+            "attempts": result.get("attempts", 1),
+            "rejected": result.get("rejected"),  # Per-entry agent messages, for batches reduced to their rejected entries
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "payload": payload if isinstance(payload, str) else str(payload, "utf-8")
+        }
+        try:
+            with self._locked():
+                self._append(self.path, [record])
+        except OSError as e:
+            logger.error(f"Could not write dead letter to {self.path}: {e}")
+
+    @staticmethod
+    def _read(path: str) -> List[dict]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _append(path: str, records):
+        with open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self, records):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _recover(self):
+        """Put back the records of replays whose worker is gone (under the lock)"""
+        for claim_path in glob.glob(glob.escape(self.path) + ".replay-*"):
+            try:
+                with open(claim_path, encoding="utf-8") as claim:
+                    try:
+                        fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # A replay is running
+                    records = [json.loads(line) for line in claim if line.strip()]
+                    self._append(self.path, records)
+                    os.remove(claim_path)
+            except FileNotFoundError:
+                continue
+            logger.warning(f"Dead letters: recovered {len(records)} batch(es) from an interrupted replay")
+
+    def load(self) -> List[dict]:
+        with self._locked():
+            self._recover()
+            return self._read(self.path)
+
+    def remove(self, ids):
+        ids = set(ids)
+        with self._locked():
+            self._rewrite([record for record in self._read(self.path) if record["id"] not in ids])
+
+    def claim(self, job_id: Optional[str] = None):
+        """Take the records (of one job) out of the file for a replay; returns (records, claim) for release()"""
+        with self._locked():
+            self._recover()
+            records = self._read(self.path)
+            claimed = [record for record in records if not job_id or record["job"] == job_id]
+            claim = open(f"{self.path}.replay-{uuid.uuid4().hex[:8]}", "w", encoding="utf-8")
+            fcntl.flock(claim, fcntl.LOCK_EX)
+            for record in claimed:
+                claim.write(json.dumps(record, separators=(",", ":")) + "\n")
+            claim.flush()
+            os.fsync(claim.fileno())
+            ids = {record["id"] for record in claimed}
+            self._rewrite([record for record in records if record["id"] not in ids])
+        return claimed, claim
+
+    def release(self, claim, records):
+        """End a replay: records still failing go back to the file"""
+        with self._locked():
+            self._append(self.path, records)
+            os.remove(claim.name)
+            claim.close()
+
+dead_letters = DeadLetterStore(DEAD_LETTER_PATH)
+
+# Mapping State
+
+class MappingState:
+    """What each agent has acknowledged: ip (int) -> (user, timeout, expiry), per agent"""
+
+    def __init__(self, max_entries: int = MAPPING_STATE_MAX):
+        self.max_entries = max_entries
+        self.agents = {}  # url -> {ip: (user, timeout, expiry)}
+        self.on_login = None  # Called with (url, ip, timeout, expiry) for each recorded login
+        self._full_warned = set()
+
+    def record(self, url: str, entries, operation: str):
+        """Apply an acknowledged batch of (ip, user, timeout) entries"""
+        if self.max_entries <= 0:
+            return
+        table = self.agents.setdefault(url, {})
+        if operation == "logout":
+            for ip, _, _ in entries:
+                table.pop(ip, None)
+            return
+        now = time.time()
+        for ip, user, timeout in entries:
+            if len(table) >= self.max_entries and ip not in table:
+                if url not in self._full_warned:
+                    self._full_warned.add(url)
+                    logger.warning(f"Mapping state for {url} is full ({self.max_entries}); new mappings are not tracked")
+                continue
+            table[ip] = (user, timeout, now + timeout)
+            if self.on_login:
+                self.on_login(url, ip, timeout, now + timeout)
+
+    def is_current(self, url: str, ip: int, user: str, horizon: float) -> bool:
+        """True if the agent has ip -> user and it will not expire before horizon"""
+        known = self.agents.get(url, {}).get(ip)
+        return known is not None and known[0] == user and known[2] > horizon
+
+    def missing(self, agents: List[str], seen) -> dict:
+        """Known mappings whose IP is not in seen, as uid entries: {url: [entry, ...]}"""
+        return {
+            url: [{"name": user, "ip": str(ipaddress.ip_address(ip)), "timeout": timeout}
+                  for ip, (user, timeout, _) in self.agents.get(url, {}).items() if ip not in seen]
+            for url in agents
+        }
+
+    def forget(self, url: Optional[str] = None):
+        if url is None:
+            self.agents.clear()
+            self._full_warned.clear()
+        else:
+            self.agents.pop(url, None)
+            self._full_warned.discard(url)
+
+    def summary(self):
+        now = time.time()
+        return {url: {"mappings": len(table), "expired": sum(1 for _, _, expiry in table.values() if expiry <= now)}
+                for url, table in self.agents.items()}
+
+mapping_state = MappingState()
+
+def range_entries(first_ip: int, size: int, user_prefix: str, user_start: int, timeout, step: int = 1):
+    """(ip, user, timeout) for the entries serialize_uid_range writes"""
+    timeout = int(timeout)
+    return [(first_ip + k, f"{user_prefix}{user_start + k}", timeout) for k in range(0, size * step, step)]
+
+def item_entries(items: List[dict]):
+    """(ip, user, timeout) for explicit uid entries"""
+    return [(int(ipaddress.ip_address(item["ip"])), item["name"], int(item["timeout"])) for item in items]
+
 # Batching Engine Implementation
-async def process_mass_mapping(request: MappingRequest):
-    global mapping_in_progress, active_mapping_task
-    stop_event.clear()
+class BatchWindow:
+    """Keeps up to max_inflight batches in flight and acknowledges them in batch order"""
+
+    def __init__(self, max_inflight: int, on_ack=None, controller: Optional[RateController] = None,
+                 retry: Optional[RetryPolicy] = None):
+        self.max_inflight = max(1, max_inflight)
+        self.on_ack = on_ack  # Called with the number of entries delivered, in batch order
+        self.controller = controller or RateController(None)
+        self.retry = retry or RetryPolicy(max_attempts=1)
+        self.acked = 0
+        self._inflight = set()
+        self._finished = {}  # index -> entry count, for batches done ahead of an earlier one
+        self._next_index = 0
+        self._next_ack = 0
+
+    async def submit(self, count: int, send, *args, on_done=None, on_attempt=None):
+        # Back-pressure: wait for a free slot before building up more work
+        while len(self._inflight) >= self.max_inflight:
+            await asyncio.wait(self._inflight, return_when=asyncio.FIRST_COMPLETED)
+        await self.controller.acquire(count)
+        task = asyncio.create_task(self._run(self._next_index, count, on_done, on_attempt, send, *args))
+        self._next_index += 1
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _run(self, index, count, on_done, on_attempt, send, *args):
+        def attempted(latency, ok):
+            self.controller.record(count, latency, ok)
+            if on_attempt:
+                on_attempt(count, latency, ok)
+        # Retries hold the window slot, so a struggling agent also slows the producer
+        result = await send_with_retry(self.retry, send, *args, on_attempt=attempted)
+        if on_done:
+            on_done(result)
+        self._finished[index] = 0 if "error" in result else count - len(result.get("rejected", ()))
+        while self._next_ack in self._finished:
+            acked = self._finished.pop(self._next_ack)
+            self._next_ack += 1
+            self.acked += acked
+            if self.on_ack and acked:
+                self.on_ack(acked)
+        return result
+
+    @property
+    def in_flight(self):
+        return len(self._inflight)
+
+    async def drain(self):
+        if self._inflight:
+            await asyncio.gather(*self._inflight)
+
+    def cancel(self):
+        for task in self._inflight:
+            task.cancel()
+
+# Checkpoint Journal
+class JobJournal:
+    """Append-only JSON-lines log of job specs and acknowledged offsets, used to resume after a restart
+
+    Each record goes out as one os.write on an O_APPEND descriptor, so records from several workers never
+    interleave. With several workers, appends hold a shared flock of path + ".lock" and compaction an exclusive
+    one, so no record is appended to a file that is being replaced.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._lock = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @contextlib.contextmanager
+    def _locked(self, mode: int):
+        if self._lock is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._lock = open(self.path + ".lock", "a")
+        fcntl.flock(self._lock, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def _append(self, record: dict, sync: bool = False):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            # A single worker compacts only at startup, before it appends anything: no lock needed
+            with self._locked(fcntl.LOCK_SH) if state_store.shared else contextlib.nullcontext():
+                if self._fd is not None and state_store.shared and self._replaced():
+                    self.sync()
+                    os.close(self._fd)
+                    self._fd = None
+                if self._fd is None:
+                    self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                os.write(self._fd, line)
+            self._unsynced += 1
+            if sync or self._unsynced >= JOURNAL_FSYNC_EVERY or time.monotonic() - self._last_sync >= JOURNAL_FSYNC_INTERVAL:
+                self.sync()
+        except OSError as e:
+            logger.error(f"Journal write failed ({self.path}): {e}")
+
+    def _replaced(self) -> bool:
+        """Another worker compacted the journal: our descriptor points at the old file"""
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._fd).st_ino
+        except OSError:
+            return True
+
+    def sync(self):
+        if self._fd is not None and self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def start(self, job, group: Optional[dict] = None):
+        self._append({"t": "start", "job": job.id, "kind": job.kind, "spec": job.request.model_dump(),
+                      "group": group}, sync=True)
+
+    def ack(self, job_id: str, offset: int):
+        self._append({"t": "ack", "job": job_id, "offset": offset})
+
+    def end(self, job_id: str, status: str):
+        self._append({"t": "end", "job": job_id, "status": status}, sync=True)
+
+    def load(self) -> dict:
+        """Replay the journal, compact it down to unfinished jobs and return those by id"""
+        with self._locked(fcntl.LOCK_EX):
+            return self._compact()
+
+    def _compact(self) -> dict:
+        jobs = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn write from a crash
+                    job_id = record.get("job")
+                    if record.get("t") == "start":
+                        jobs[job_id] = {"job_id": job_id, "kind": record["kind"], "spec": record["spec"],
+                                        "group": record.get("group"),
+                                        "offset": record["spec"].get("start_offset", 0)}
+                    elif record.get("t") == "ack" and job_id in jobs:
+                        jobs[job_id]["offset"] = record["offset"]
+                    elif record.get("t") == "end":
+                        jobs.pop(job_id, None)
+        except FileNotFoundError:
+            return {}
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in jobs.values():
+                f.write(json.dumps({"t": "start", "job": job["job_id"], "kind": job["kind"], "spec": job["spec"],
+                                    "group": job["group"]}, separators=(",", ":")) + "\n")
+                f.write(json.dumps({"t": "ack", "job": job["job_id"], "offset": job["offset"]},
+                                   separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return jobs
+
+journal = JobJournal(JOURNAL_PATH)
+
+# Jobs found unfinished in the journal at startup: job_id -> {"kind", "spec", "group", "offset"}
+interrupted_jobs = {}
+
+# Job Registry
+class MappingJob:
+    """One bulk, subnet, import, sync or tag update run, its progress and its controls"""
+
+    def __init__(self, kind: str, request, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.kind = kind  # "bulk", "subnet", "import", "sync" or "tags"
+        self.request = request
+        self.status = "queued"  # queued, running, paused, completed, cancelled, failed
+        self.current = 0
+        self.failed = 0  # Entries in batches that exhausted their retries
+        self.total = 0
+        self.error = None
+        self.created = datetime.now()
+        self.started = 0.0
+        self.finished = 0.0
+        self.dispatcher = None
+        self.pipeline = None  # PayloadPipeline building this job's batches ahead, if any
+        self.task = None
+        self.acked_offset = getattr(request, "start_offset", 0)  # Every entry before this offset is acknowledged
+        self._ranges_done = {}  # batch index -> end offset, for batches finished out of order
+        self._next_range = 0
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._stop = False
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running", "paused")
+
+    def begin(self, total: int, dispatcher):
+        self.total = total
+        self.dispatcher = dispatcher
+
+    def advance(self, count: int):
+        self.current += count
+
+    def record_failure(self, count: int):
+        self.failed += count
+
+    @property
+    def journaled(self) -> bool:
+        """Only kinds that can be rebuilt from their spec and offset go in the journal (see JOB_ENGINES)"""
+        return self.kind in JOB_ENGINES
+
+    def range_done(self, index: int, end_offset: int):
+        """Batch index finished on every agent; checkpoint the contiguous acked offset"""
+        self._ranges_done[index] = end_offset
+        if self._next_range not in self._ranges_done:
+            return
+        while self._next_range in self._ranges_done:
+            self.acked_offset = self._ranges_done.pop(self._next_range)
+            self._next_range += 1
+        if self.journaled:
+            journal.ack(self.id, self.acked_offset)
+
+    async def checkpoint(self):
+        """Called between batches: blocks while paused, raises once the job is stopped"""
+        if not self._resume.is_set():
+            await self._resume.wait()
+        if self._stop:
+            raise asyncio.CancelledError()
+
+    def pause(self):
+        if self.status == "running":
+            self._resume.clear()
+            self.status = "paused"
+            logger.info(f"[{self.id}] Paused")
+
+    def resume(self):
+        if self.status == "paused":
+            self.status = "running"
+            self._resume.set()
+            logger.info(f"[{self.id}] Resumed")
+
+    def cancel(self):
+        self._stop = True
+        self._resume.set()
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def to_dict(self):
+        elapsed = (self.finished or time.monotonic()) - self.started if self.started else 0
+        rate = self.dispatcher.rate if self.dispatcher else None
+        tuner = self.dispatcher.tuner if self.dispatcher else None
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "current": self.current,
+            "failed": self.failed,
+            "total": self.total,
+            "running": self.active,
+            "rate_limit": round(rate) if rate else None,
+            "batch_size": tuner.size if tuner else getattr(self.request, "batch_size", None),
+            "batch_tuning": tuner.to_dict() if tuner else None,
+            "pipeline": self.pipeline.to_dict() if self.pipeline else None,
+            "entries_per_sec": round(self.current / elapsed) if elapsed > 0 else 0,
+            "agents": self.dispatcher.stats if self.dispatcher else {},
+            "error": self.error,
+            "acked_offset": self.acked_offset,
+            "created": self.created.isoformat(timespec="seconds")
+        }
+
+class JobManager:
+    """Runs mapping jobs concurrently, up to max_concurrent at a time"""
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_JOBS, history: int = JOB_HISTORY):
+        self.jobs = {}  # job_id -> MappingJob, in submission order
+        self.history = history
+        self._slots = asyncio.Semaphore(max(1, max_concurrent))
+
+    def submit(self, kind: str, request, engine, job_id: Optional[str] = None) -> MappingJob:
+        job = MappingJob(kind, request, job_id)
+        self.jobs[job.id] = job
+        group = agent_groups.get(request.agent_group) if request.agent_group else None
+        if job.journaled:
+            journal.start(job, group.model_dump() if group else None)
+        job.task = asyncio.create_task(self._run(job, engine))
+        self._prune()
+        return job
+
+    async def _run(self, job: MappingJob, engine):
+        try:
+            async with self._slots:
+                job.status = "running"
+                job.started = time.monotonic()
+                await engine(job.request, job)
+            job.status = "failed" if job.error else "completed"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        finally:
+            job.finished = time.monotonic()
+            # A cancel that did not come from the user is a shutdown: leave the job resumable
+            if job.journaled and (job.status != "cancelled" or job._stop):
+                journal.end(job.id, job.status)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> MappingJob:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+        return job
+
+    def latest(self) -> Optional[MappingJob]:
+        return next(reversed(self.jobs.values()), None)
+
+    def active(self) -> List[MappingJob]:
+        return [job for job in self.jobs.values() if job.active]
+
+job_manager = JobManager()
+
+# Shared State
+# With several uvicorn workers each process runs its own jobs; job snapshots, log lines, configuration
+# and job commands go through a shared store so any worker can answer for (and control) any job.
+class StateStore:
+    """Single-process store: everything stays in this worker's globals. Subclass for a shared backend."""
+
+    shared = False
+
+    def __init__(self):
+        # Unique per process: a restarted container reuses hostname and pid. The run prefix tells this start's
+        # workers from the previous one's, whose heartbeats can still look fresh after a crash.
+        self.owner = f"{RUN_ID}.{uuid.uuid4().hex[:8]}@{socket.gethostname()}:{os.getpid()}"
+
+    @staticmethod
+    def same_run(owner: str) -> bool:
+        return owner.split(".", 1)[0] == RUN_ID
+
+    def heartbeat(self):
+        pass
+
+    def claim(self, name: str) -> bool:
+        """Take a once-per-deployment duty (journal replay, refresh scheduler); True if this worker holds it"""
+        return True
+
+    def publish_jobs(self, snapshots: List[dict]):
+        pass
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        return None
+
+    def list_jobs(self) -> List[dict]:
+        return []
+
+    def send_command(self, owner: str, job_id: str, action: str):
+        pass
+
+    def take_commands(self) -> List[tuple]:
+        return []
+
+    def append_logs(self, lines: List[str]):
+        pass
+
+    def logs_since(self, since: int):
+        return [], since
+
+    def get_config(self, key: str, default=None):
+        return default
+
+    def set_config(self, key: str, value):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteStateStore(StateStore):
+    """SQLite in WAL mode: one file shared by every worker on the host"""
+
+    shared = True
+    LOG_KEEP = 1000  # Lines kept in the table
+    LOG_READ = 200  # Most lines returned by one logs_since
+
+    def __init__(self, path: str = STATE_DB_PATH, stale_after: float = STATE_STALE_AFTER):
+        super().__init__()
+        self.stale_after = stale_after
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS workers (owner TEXT PRIMARY KEY, seen REAL);
+            CREATE TABLE IF NOT EXISTS claims (name TEXT PRIMARY KEY, owner TEXT);
+            CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner TEXT, created TEXT, active INTEGER, data TEXT);
+            CREATE TABLE IF NOT EXISTS commands (id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT, job TEXT, action TEXT);
+            CREATE TABLE IF NOT EXISTS logs (seq INTEGER PRIMARY KEY AUTOINCREMENT, line TEXT);
+            CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                results = [self._db.execute(sql, params).fetchall() for sql, params in statements]
+                self._db.execute("COMMIT")
+                return results
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _alive(self, owner: str) -> bool:
+        if owner == self.owner:
+            return True
+        if not self.same_run(owner):
+            return False  # Left over from before this start
+        row = self._execute("SELECT seen FROM workers WHERE owner = ?", (owner,))
+        return bool(row) and time.time() - row[0][0] < self.stale_after
+
+    def heartbeat(self):
+        self._execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.owner, time.time()))
+
+    def claim(self, name: str) -> bool:
+        self.heartbeat()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT c.owner, w.seen FROM claims c LEFT JOIN workers w ON w.owner = c.owner "
+                                       "WHERE c.name = ?", (name,)).fetchall()
+                held = (row and row[0][0] != self.owner and self.same_run(row[0][0])
+                        and time.time() - (row[0][1] or 0) < self.stale_after)
+                if not held:
+                    self._db.execute("INSERT OR REPLACE INTO claims VALUES (?, ?)", (name, self.owner))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return not held
+
+    def publish_jobs(self, snapshots: List[dict]):
+        self._transaction([("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)",
+                            (s["job_id"], self.owner, s["created"], int(s["running"]), json.dumps(s)))
+                           for s in snapshots])
+
+    def _snapshot(self, owner: str, active: int, data: str) -> dict:
+        snapshot = json.loads(data)
+        snapshot["worker"] = owner
+        if active and not self._alive(owner):
+            # Its worker died mid-job: the journal has it as interrupted
+            snapshot.update(status="interrupted", running=False)
+        return snapshot
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        rows = self._execute("SELECT owner, active, data FROM jobs WHERE id = ?", (job_id,))
+        return self._snapshot(*rows[0]) if rows else None
+
+    def list_jobs(self) -> List[dict]:
+        rows = self._execute("SELECT owner, active, data FROM jobs ORDER BY created, rowid")
+        return [self._snapshot(*row) for row in rows]
+
+    def prune_jobs(self, keep: int):
+        self._execute("DELETE FROM jobs WHERE active = 0 AND id NOT IN "
+                      "(SELECT id FROM jobs WHERE active = 0 ORDER BY created DESC LIMIT ?)", (keep,))
+
+    def send_command(self, owner: str, job_id: str, action: str):
+        self._execute("INSERT INTO commands (owner, job, action) VALUES (?, ?, ?)", (owner, job_id, action))
+
+    def take_commands(self) -> List[tuple]:
+        rows, _ = self._transaction([("SELECT job, action FROM commands WHERE owner = ? ORDER BY id", (self.owner,)),
+                                     ("DELETE FROM commands WHERE owner = ?", (self.owner,))])
+        return rows
+
+    def append_logs(self, lines: List[str]):
+        self._transaction([("INSERT INTO logs (line) VALUES (?)", (line,)) for line in lines] +
+                          [("DELETE FROM logs WHERE seq <= (SELECT MAX(seq) FROM logs) - ?", (self.LOG_KEEP,))])
+
+    def logs_since(self, since: int):
+        rows = self._execute("SELECT seq, line FROM logs WHERE seq > ? ORDER BY seq DESC LIMIT ?", (since, self.LOG_READ))
+        if not rows:
+            newest = self._execute("SELECT MAX(seq) FROM logs")[0][0] or 0
+            if since > newest:
+                return self.logs_since(0)  # Counted against a state file that has been replaced
+            return [], newest
+        return [line for _, line in reversed(rows)], rows[0][0]
+
+    def get_config(self, key: str, default=None):
+        rows = self._execute("SELECT value FROM config WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_config(self, key: str, value):
+        self._execute("INSERT OR REPLACE INTO config VALUES (?, ?)", (key, json.dumps(value)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# STATE_BACKEND -> store class; add an entry to plug in another backend
+STATE_BACKENDS = {"memory": StateStore, "sqlite": SQLiteStateStore}
+
+def make_state_store(backend: str) -> StateStore:
+    if backend not in STATE_BACKENDS:
+        raise ValueError(f"Unknown STATE_BACKEND: {backend}. Use {', '.join(STATE_BACKENDS)}")
+    return STATE_BACKENDS[backend]()
+
+state_store = make_state_store(STATE_BACKEND)
+
+def load_shared_config():
+    """Pull configuration other workers may have changed into this worker's globals"""
+    global configured_uia_url, config_verified
+    if not state_store.shared:
+        return
+    configured_uia_url = state_store.get_config("uia_url", configured_uia_url)
+    config_verified = state_store.get_config("config_verified", config_verified)
+    groups = state_store.get_config("agent_groups")
+    if groups is not None:
+        agent_groups.clear()
+        agent_groups.update((name, AgentGroupRequest(**group)) for name, group in groups.items())
+
+def save_agent_groups():
+    state_store.set_config("agent_groups", {name: group.model_dump() for name, group in agent_groups.items()})
+
+def save_connection_config():
+    state_store.set_config("uia_url", configured_uia_url)
+    state_store.set_config("config_verified", config_verified)
+
+def load_interrupted_jobs():
+    if state_store.shared:
+        interrupted_jobs.clear()
+        interrupted_jobs.update(state_store.get_config("interrupted_jobs", {}))
+
+def save_interrupted_jobs():
+    state_store.set_config("interrupted_jobs", interrupted_jobs)
+
+class StateSync:
+    """Per-worker loop: heartbeat, publish this worker's jobs and log lines, run commands sent to its jobs"""
+
+    def __init__(self, store: StateStore, interval: float = STATE_SYNC_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.task = None
+        self._published = set()  # Finished jobs whose final snapshot is already in the store
+
+    def start(self):
+        global log_outbox
+        with buffer_lock:
+            log_outbox = collections.deque(maxlen=10000)
+        self.task = asyncio.create_task(self._run())
+        logger.info(f"Shared state: {type(self.store).__name__} as worker {self.store.owner}")
+
+    async def _run(self):
+        while True:
+            try:
+                self.tick()
+            except sqlite3.Error as e:
+                logger.error(f"Shared state sync failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def tick(self):
+        self.store.heartbeat()
+        with buffer_lock:
+            lines = list(log_outbox) if log_outbox else []
+            if lines:
+                log_outbox.clear()
+        if lines:
+            self.store.append_logs(lines)
+        snapshots = [job.to_dict() for job in job_manager.jobs.values()
+                     if job.active or job.id not in self._published]
+        if snapshots:
+            self.store.publish_jobs(snapshots)
+            self._published.update(s["job_id"] for s in snapshots if not s["running"])
+            self._published &= set(job_manager.jobs)
+            self.store.prune_jobs(JOB_HISTORY)
+        for job_id, action in self.store.take_commands():
+            job = job_manager.jobs.get(job_id)
+            if job is None:
+                continue
+            logger.info(f"[{job_id}] {action} requested by another worker")
+            if action == "cancel":
+                job.cancel()
+            elif action == "pause":
+                job.pause()
+            elif action == "resume":
+                job.resume()
+        load_shared_config()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.tick()  # Final job states for the other workers
+
+state_sync = StateSync(state_store)
+
+def job_snapshot(job_id: str) -> dict:
+    """Progress of a job run by this or any other worker; 404 if none knows it"""
+    job = job_manager.jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    snapshot = state_store.get_job(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return snapshot
+
+def all_job_snapshots() -> List[dict]:
+    """Every worker's jobs, oldest first; this worker's own are live rather than last published"""
+    local = {job.id: job.to_dict() for job in job_manager.jobs.values()}
+    snapshots = [local.pop(s["job_id"], s) for s in state_store.list_jobs()]
+    return snapshots + list(local.values())
+
+def latest_job_snapshot() -> Optional[dict]:
+    if not state_store.shared:
+        job = job_manager.latest()
+        return job.to_dict() if job else None
+    snapshots = all_job_snapshots()
+    return max(reversed(snapshots), key=lambda s: s["created"]) if snapshots else None
+
+def remote_job(job_id: str) -> Optional[dict]:
+    """Snapshot of a job another worker runs, or None if it is local or unknown"""
+    if job_id in job_manager.jobs:
+        return None
+    return state_store.get_job(job_id)
+
+# Multi-agent fan-out
+def resolve_agents(uia_url: Optional[str], agent_group: Optional[str]):
+    """Agents a request targets and the distribution mode; raises ValueError"""
+    if agent_group:
+        group = agent_groups.get(agent_group)
+        if group is None:
+            load_shared_config()  # Maybe just saved through another worker
+            group = agent_groups.get(agent_group)
+        if group is None:
+            raise ValueError(f"Unknown agent group: {agent_group}")
+        return group.agents, group.mode
+    if not uia_url:
+        raise ValueError("Either uia_url or agent_group is required")
+    return [uia_url], "broadcast"
+
+def shard_for_ip(ip: str, agent_count: int) -> int:
+    # IP modulo group size, so an IP always lands on the same agent for login, logout and tags
+    return int(ipaddress.ip_address(ip)) % agent_count
+
+def shard_for_user(user: str, agent_count: int) -> int:
+    return zlib.crc32(user.encode()) % agent_count
+
+class AgentDispatcher:
+    """Fans batches out to one or more agents, each with its own window and rate controller"""
+
+    def __init__(self, agents: List[str], mode: str, max_inflight: int, rate_mode: str,
+                 rate_limit: Optional[float], cert_path: str = "", on_progress=None,
+                 max_attempts: int = RETRY_MAX_ATTEMPTS, job_id: str = "", on_failure=None, state=None,
+                 tuner: Optional[BatchSizeTuner] = None):
+        self.agents = agents
+        self.mode = mode
+        self.cert_path = cert_path
+        self.job_id = job_id
+        self.on_progress = on_progress  # Called with entry counts as agents ack them
+        self.on_failure = on_failure  # Called with entry counts of batches that went to the dead-letter file
+        self.state = state  # MappingState updated with every acknowledged uid batch, if set
+        self.tuner = tuner  # BatchSizeTuner fed the latency of every range batch send, if set
+        self.stats = {url: {"acked": 0, "failed": 0, "failed_batches": 0, "retries": 0, "rejected": 0,
+                            "last_error": None} for url in agents}
+        self.windows = {
+            url: BatchWindow(max_inflight, functools.partial(self._on_ack, url),
+                             make_rate_controller(rate_mode, rate_limit), RetryPolicy(max_attempts))
+            for url in agents
+        }
+
+    @property
+    def rate(self):
+        rates = [window.controller.rate for window in self.windows.values()]
+        return sum(rates) if all(rates) else None
+
+    def expected_deliveries(self, total: int) -> int:
+        return total * len(self.agents) if self.mode == "broadcast" else total
+
+    def _on_ack(self, url, count):
+        self.stats[url]["acked"] += count
+        metrics.inc("uia_entries_acked_total", count, agent=url)
+        if self.on_progress:
+            self.on_progress(count)
+
+    def _on_result(self, url, count, payload, result):
+        stats = self.stats[url]
+        stats["retries"] += result.get("attempts", 1) - 1
+        if result.get("attempts", 1) > 1:
+            metrics.inc("uia_batch_retries_total", result["attempts"] - 1, agent=url)
+        if result.get("rejected"):
+            self._on_rejected(url, payload, result)
+        if "error" not in result:
+            return
+        metrics.inc("uia_batches_dead_lettered_total", agent=url)
+        stats["failed"] += count
+        stats["failed_batches"] += 1
+        stats["last_error"] = result["error"]
+        logger.error(f"Batch of {count} failed on {url} after {result.get('attempts', 1)} attempt(s): {result['error']}")
+        dead_letters.add(self.job_id, url, self.cert_path, count, payload, result)
+        if self.on_failure:
+            self.on_failure(count)
+
+    def _on_rejected(self, url, payload, result):
+        """Count and dead-letter only the entries the agent rejected, so a replay resends just those"""
+        stats = self.stats[url]
+        try:
+            payload, count = select_payload_entries(payload, result["rejected"])
+        except ET.ParseError:
+            count = len(result["rejected"])
+        stats["rejected"] += count
+        stats["failed"] += count
+        stats["last_error"] = result["rejected"][0]["message"]
+        stats["rejected_sample"] = result["rejected"][:5]
+        if count:
+            dead_letters.add(self.job_id, url, self.cert_path, count, payload,
+                             {"error": f"Rejected by agent: {stats['last_error']}", "error_class": "rejected",
+                              "attempts": result.get("attempts", 1), "rejected": result["rejected"]})
+        if self.on_failure:
+            self.on_failure(count)
+
+    async def submit_range(self, first_ip: int, size: int, version: int, user_prefix: str,
+                           user_start: int, timeout, event_type: str, on_done=None, parts=None, on_attempt=None):
+        """Queue one batch to its agents; on_done fires once every agent has finished its part
+
+        parts is the batch's plan_range_payloads result when it was built ahead (PayloadPipeline).
+        on_attempt(count, latency, ok) is called after each send attempt, timed from when the send starts.
+        """
+        if parts is None:
+            parts = plan_range_payloads(first_ip, size, version, user_prefix, user_start, timeout, event_type,
+                                        len(self.agents), self.mode == "shard", cache=get_payload_cache())
+        sends = []
+        for index, part_ip, count, part_start, step, payload in parts:
+            entries = functools.partial(range_entries, part_ip, count, user_prefix, part_start, timeout, step)
+            sends += [(url, count, payload, entries) for url in (self.agents if index is None else [self.agents[index]])]
+        await self._submit_sends(sends, event_type, on_done, size, on_attempt)
+
+    async def submit_items(self, items: List[dict], build, action: str, shard_key, on_done=None):
+        """Queue one batch of tag items (or explicit entries) to its agents, sharded with shard_key"""
+        agent_count = len(self.agents)
+        if self.mode != "shard" or agent_count == 1:
+            payload = build(items, action)
+            sends = [(url, len(items), payload, functools.partial(item_entries, items)) for url in self.agents]
+        else:
+            shards = [[] for _ in self.agents]
+            for item in items:
+                shards[shard_key(item, agent_count)].append(item)
+            sends = [(url, len(shard), build(shard, action), functools.partial(item_entries, shard))
+                     for url, shard in zip(self.agents, shards) if shard]
+        await self._submit_sends(sends, action, on_done)
+
+    async def submit_agent_items(self, url: str, items: List[dict], build, action: str, on_done=None):
+        """Queue a batch for one agent only, e.g. logouts of mappings only that agent holds"""
+        await self._submit_sends([(url, len(items), build(items, action), functools.partial(item_entries, items))],
+                                 action, on_done)
+
+    async def _submit_sends(self, sends, operation: str, on_done=None, size: Optional[int] = None, on_attempt=None):
+        remaining = len(sends)
+        def part_done(url, count, payload, entries, result):
+            nonlocal remaining
+            self._on_result(url, count, payload, result)
+            if self.state is not None and "error" not in result:
+                skip = rejected_ips(result)
+                self.state.record(url, [e for e in entries() if e[0] not in skip] if skip else entries(), operation)
+            remaining -= 1
+            if remaining == 0 and on_done:
+                on_done()
+        # Sends are scored against the size the batch was handed out at, even when sharding splits it
+        if self.tuner and size:
+            tuned, caller = functools.partial(self.tuner.record, size), on_attempt
+            def on_attempt(count, latency, ok):
+                tuned(count, latency, ok)
+                if caller:
+                    caller(count, latency, ok)
+        for url, count, payload, entries in sends:
+            await self.windows[url].submit(count, send_payload_async, payload, self.cert_path, url,
+                                           on_done=functools.partial(part_done, url, count, payload, entries),
+                                           on_attempt=on_attempt)
+
+    async def drain(self):
+        await asyncio.gather(*(window.drain() for window in self.windows.values()))
+
+    def cancel(self):
+        for window in self.windows.values():
+            window.cancel()
+
+async def dispatch_items(agents: List[str], mode: str, items: List[dict], shard_key, build, action: str,
+                         cert_path: str = ""):
+    """Send a tag update to every agent (or each agent its shard) concurrently; returns {url: result}"""
+    if mode == "shard" and len(agents) > 1:
+        shards = {url: [] for url in agents}
+        for item in items:
+            shards[agents[shard_key(item, len(agents))]].append(item)
+        payloads = {url: build(shard, action) for url, shard in shards.items() if shard}
+    else:
+        payload = build(items, action)
+        payloads = {url: payload for url in agents}
+    results = await asyncio.gather(*(send_payload_async(payload, cert_path, url) for url, payload in payloads.items()))
+    return dict(zip(payloads, results))
+
+def tag_update_response(kind: str, results: dict, single: bool):
+    """Single agent: its result or a 500. Group: per-agent results, 500 only if every agent failed"""
+    failed = {url: result["error"] for url, result in results.items() if "error" in result}
+    for url, error in failed.items():
+        logger.error(f"{kind} error on {url}: {error}")
+    if single:
+        result = next(iter(results.values()))
+        if "error" in result:
+            raise HTTPException(status_code=500, detail=result["error"])
+        logger.info(f"{kind} update complete")
+        return result
+    if failed and len(failed) == len(results):
+        raise HTTPException(status_code=500, detail={"message": f"{kind} update failed on every agent", "failed": failed})
+    logger.info(f"{kind} update complete on {len(results) - len(failed)}/{len(results)} agents")
+    return {"message": f"{kind} update sent to {len(results)} agents", "failed": failed, "results": results}
+
+def subnet_host_range(network):
+    """First host (as int) and host count, following ipaddress hosts() rules"""
+    first = int(network.network_address)
+    size = network.num_addresses
+    if size <= 2:
+        return first, size  # /31, /32, /127, /128: every address is usable
+    if network.version == 4:
+        return first + 1, size - 2  # Skip network and broadcast
+    return first + 1, size - 1  # Skip the subnet-router anycast address
+
+def plan_subnet(request: MappingRequest):
+    """Resolve a subnet request to (network, first host, entries to send); raises ValueError"""
+    network = ipaddress.ip_network(request.subnet)
+    first, host_count = subnet_host_range(network)
+    if request.start_offset < 0:
+        raise ValueError("start_offset must not be negative")
+    if request.max_count is None and host_count > SUBNET_MAX_ENTRIES:
+        raise ValueError(f"{request.subnet} has {host_count} hosts; set max_count (limit without it: {SUBNET_MAX_ENTRIES})")
+    total = max(0, host_count - request.start_offset)
+    if request.max_count is not None:
+        total = min(total, request.max_count)
+    return network, first + request.start_offset, total
+
+def plan_range_payloads(first_ip: int, size: int, version: int, user_prefix: str, user_start: int, timeout,
+                        event_type: str, agent_count: int = 1, shard: bool = False, cache=None, build: bool = True):
+    """Payloads for one range batch: [(agent index or None for every agent, first_ip, count, user_start, step, payload)]
+
+    Payloads found in cache are read from it; the rest are built and stored, or left None when not build.
+    Without a cache this is a plain function of its arguments, so pipeline worker processes can run it.
+    """
+    if not shard or agent_count == 1:
+        slices = [(None, first_ip, size, user_start, 1)]
+    else:
+        slices = []
+        for index in range(agent_count):
+            # Agent index owns every IP with ip % agent_count == index: a strided slice of the batch
+            skip = (index - first_ip) % agent_count
+            count = len(range(skip, size, agent_count))
+            if count:
+                slices.append((index, first_ip + skip, count, user_start + skip, agent_count))
+    parts = []
+    for part in slices:
+        args = range_part_args(version, user_prefix, timeout, event_type, part)
+        payload = cache.get(args) if cache else None
+        if payload is None and build:
+            payload = build_uid_range_payload(*args)
+            if cache:
+                cache.put(args, payload)
+        parts.append(part + (payload,))
+    return parts
+
+def range_part_args(version: int, user_prefix: str, timeout, event_type: str, part) -> tuple:
+    """build_uid_range_payload arguments for one (agent index, first_ip, count, user_start, step) part"""
+    _, first_ip, count, user_start, step = part[:5]
+    return (first_ip, count, version, user_prefix, user_start, timeout, event_type, step)
+
+def timed_plan_range_payloads(*args):
+    started = time.perf_counter()
+    parts = plan_range_payloads(*args)
+    return parts, time.perf_counter() - started
+
+# Payload Cache
+class PayloadCache:
+    """Built payloads on disk, keyed by a hash of everything that goes into them
+
+    Payloads are appended to segment files as records (16-byte key, 4-byte length, payload) and read back
+    through read-only memory maps: a hit is a memoryview of the mapping, handed to the socket without a copy.
+    The index is rebuilt from the record headers when the cache is opened. Once the segments outgrow
+    max_bytes the least recently used one is deleted (segment mtimes carry the order across restarts).
+    Each process appends to segments of its own, so uvicorn workers can share the directory.
+    """
+
+    FORMAT = 1  # Part of every key: bump when the payload builders' output changes
+    HEADER = struct.Struct("<16sI")
+    TOUCH_INTERVAL = 60  # Seconds between mtime updates of a segment that is being read
+
+    def __init__(self, path: str, max_bytes: int, segment_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.index = {}  # key -> (segment name, offset, length)
+        self.segments = collections.OrderedDict()  # name -> segment dict, least recently used first
+        self.active = None  # Name of the segment this process appends to
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    @classmethod
+    def key(cls, args) -> bytes:
+        return hashlib.blake2b(json.dumps([cls.FORMAT, FAST_XML, *args]).encode(), digest_size=16).digest()
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        names = [name for name in os.listdir(self.path) if name.endswith(".seg")]
+        mtimes = {}
+        for name in names:
+            try:
+                mtimes[name] = os.path.getmtime(os.path.join(self.path, name))
+            except OSError:
+                pass  # Evicted by another worker meanwhile
+        for name in sorted(mtimes, key=mtimes.get):
+            segment = {"map": None, "fd": None, "used": 0, "keys": [], "touched": mtimes[name]}
+            self.segments[name] = segment
+            try:
+                segment["map"] = self._map(name)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Payload cache: dropping unreadable segment {name}: {e}")
+                self._remove(name)
+                continue
+            view, offset = segment["map"], 0
+            while offset + self.HEADER.size <= len(view):
+                key, length = self.HEADER.unpack_from(view, offset)
+                if offset + self.HEADER.size + length > len(view):
+                    break  # Torn write: the writer stopped mid-record
+                self.index[key] = (name, offset + self.HEADER.size, length)
+                segment["keys"].append(key)
+                offset += self.HEADER.size + length
+            segment["used"] = offset
+            self.bytes += offset
+        self._evict()
+        logger.info(f"Payload cache: {len(self.index)} payload(s), {self.bytes >> 20} MiB in {self.path}")
+
+    def _map(self, name: str) -> mmap.mmap:
+        with open(os.path.join(self.path, name), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, args) -> Optional[memoryview]:
+        location = self.index.get(self.key(args))
+        segment = self.segments.get(location[0]) if location else None
+        if segment is not None:
+            name, offset, length = location
+            try:
+                if segment["map"] is None or offset + length > len(segment["map"]):
+                    # Our own segment has grown since it was mapped; views of the old map stay valid
+                    segment["map"] = self._map(name)
+                now = time.time()
+                if now - segment["touched"] > self.TOUCH_INTERVAL:
+                    os.utime(os.path.join(self.path, name))
+                    segment["touched"] = now
+            except (OSError, ValueError):
+                self._remove(name)  # Evicted by another worker
+            else:
+                self.segments.move_to_end(name)
+                self.hits += 1
+                metrics.inc("uia_payload_cache_total", result="hit")
+                return memoryview(segment["map"])[offset:offset + length]
+        self.misses += 1
+        metrics.inc("uia_payload_cache_total", result="miss")
+        return None
+
+    def put(self, args, payload: bytes):
+        key = self.key(args)
+        record = self.HEADER.pack(key, len(payload)) + payload
+        if key in self.index or len(record) > self.max_bytes:
+            return
+        segment = self.segments.get(self.active)
+        if segment is None or segment["used"] + len(record) > self.segment_bytes:
+            segment = self._start_segment()
+        try:
+            if os.write(segment["fd"], record) != len(record):
+                raise OSError("short write")
+        except OSError as e:
+            logger.warning(f"Payload cache write failed ({self.path}): {e}")
+            self.seal()
+            return
+        self.index[key] = (self.active, segment["used"] + self.HEADER.size, len(payload))
+        segment["keys"].append(key)
+        segment["used"] += len(record)
+        self.bytes += len(record)
+        self.segments.move_to_end(self.active)
+        self._evict()
+
+    def _start_segment(self) -> dict:
+        self.seal()
+        self.active = f"{time.time_ns():x}-{os.getpid()}.seg"
+        fd = os.open(os.path.join(self.path, self.active), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segments[self.active] = {"map": None, "fd": fd, "used": 0, "keys": [], "touched": time.time()}
+        return self.segments[self.active]
+
+    def seal(self):
+        """Stop appending to the current segment; the next put starts a new one"""
+        segment = self.segments.get(self.active)
+        if segment is not None and segment["fd"] is not None:
+            os.close(segment["fd"])
+            segment["fd"] = None
+        self.active = None
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.segments:
+            self._remove(next(iter(self.segments)))
+            self.evictions += 1
+
+    def _remove(self, name: str):
+        if name == self.active:
+            self.seal()
+        segment = self.segments.pop(name)
+        for key in segment["keys"]:
+            if self.index.get(key, (None,))[0] == name:
+                del self.index[key]
+        self.bytes -= segment["used"]
+        # Not closed: memoryviews handed out may still be waiting to be sent, and keep the mapping alive
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def clear(self) -> int:
+        removed = len(self.index)
+        for name in list(self.segments):
+            self._remove(name)
+        return removed
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": True,
+            "path": self.path,
+            "payloads": len(self.index),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "segments": len(self.segments),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
+
+payload_cache = None  # Opened on first use, so pipeline worker processes never touch it
+
+def get_payload_cache() -> Optional[PayloadCache]:
+    global payload_cache
+    if payload_cache is None and PAYLOAD_CACHE_MB > 0:
+        payload_cache = PayloadCache(PAYLOAD_CACHE_DIR, PAYLOAD_CACHE_MB << 20, PAYLOAD_CACHE_SEGMENT_MB << 20)
+    return payload_cache
+
+# Payload Pipeline
+payload_pool = None  # Shared by every job's pipeline, started on first use
+
+def get_payload_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global payload_pool
+    if payload_pool is None:
+        # spawn, not fork: the server process has threads and an event loop a forked child must not inherit
+        payload_pool = concurrent.futures.ProcessPoolExecutor(PIPELINE_WORKERS,
+                                                              mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Payload pipeline: {PIPELINE_WORKERS} worker process(es)")
+    return payload_pool
+
+class PayloadPipeline:
+    """Builds range batches in the process pool up to depth batches ahead of the sender, handed over in order"""
+
+    def __init__(self, depth: int = PIPELINE_DEPTH):
+        self.depth = max(1, depth)
+        self.queue = asyncio.Queue(maxsize=self.depth)
+        self.built = 0
+        self.cached = 0  # Batches read from the payload cache instead
+        self.build_seconds = 0.0  # Worker time spent building, summed over processes
+        self.producer_wait = 0.0  # Producer blocked on a full queue: sending is the bottleneck
+        self.sender_wait = 0.0  # Sender blocked on an empty queue: building is the bottleneck
+        self._error = None
+
+    async def _produce(self, batches, plan_args):
+        loop = asyncio.get_running_loop()
+        pool = get_payload_pool()
+        cache = get_payload_cache()
+        try:
+            for batch in batches:
+                args = plan_args(batch)
+                parts = plan_range_payloads(*args, cache=cache, build=False) if cache else None
+                if parts and all(part[-1] is not None for part in parts):
+                    future = loop.create_future()
+                    future.set_result((parts, None))
+                else:
+                    future = loop.run_in_executor(pool, timed_plan_range_payloads, *args)
+                started = time.perf_counter()
+                await self.queue.put((batch, future))
+                waited = time.perf_counter() - started
+                self.producer_wait += waited
+                metrics.inc("uia_pipeline_wait_seconds_total", waited, stage="producer")
+        except Exception as e:
+            self._error = e
+        await self.queue.put(None)
+
+    async def map(self, batches, plan_args):
+        """Yield (batch, parts) in batch order; plan_args(batch) gives plan_range_payloads' arguments"""
+        producer = asyncio.create_task(self._produce(batches, plan_args))
+        try:
+            while True:
+                started = time.perf_counter()
+                item = await self.queue.get()
+                if item is None:
+                    break
+                batch, future = item
+                parts, build_seconds = await future
+                waited = time.perf_counter() - started
+                self.sender_wait += waited
+                metrics.inc("uia_pipeline_wait_seconds_total", waited, stage="sender")
+                if build_seconds is None:
+                    self.cached += 1
+                else:
+                    self.built += 1
+                    self.build_seconds += build_seconds
+                    metrics.observe("uia_pipeline_build_seconds", build_seconds)
+                    cache = get_payload_cache()
+                    if cache:
+                        version, user_prefix, _, timeout, event_type = plan_args(batch)[2:7]
+                        for part in parts:
+                            cache.put(range_part_args(version, user_prefix, timeout, event_type, part), part[-1])
+                yield batch, parts
+            if self._error:
+                raise self._error
+        finally:
+            producer.cancel()
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item:
+                    item[1].cancel()
+
+    def to_dict(self):
+        return {
+            "workers": PIPELINE_WORKERS,
+            "queue_depth": self.queue.qsize(),
+            "max_depth": self.depth,
+            "built": self.built,
+            "cached": self.cached,
+            "build_ms_avg": round(self.build_seconds / self.built * 1000, 3) if self.built else None,
+            "producer_wait_s": round(self.producer_wait, 3),
+            "sender_wait_s": round(self.sender_wait, 3),
+        }
+
+async def plan_batches(batches, plan_args, pipeline: Optional[PayloadPipeline]):
+    """Yield (batch, parts): parts built ahead by the pipeline, or None to build them in submit_range"""
+    if pipeline is None:
+        for batch in batches:
+            yield batch, None
+        return
+    async with contextlib.aclosing(pipeline.map(batches, plan_args)) as planned:
+        async for item in planned:
+            yield item
+
+def iter_range_batches(first_ip: int, total: int, batch_size):
+    """Yield (offset, first_ip, size) for each batch without materializing addresses
+
+    batch_size is an int, or a callable asked for the size of each batch as it is produced (auto-tuning).
+    """
+    next_size = batch_size if callable(batch_size) else lambda: batch_size
+    offset = 0
+    while offset < total:
+        size = min(max(1, next_size()), total - offset)
+        yield offset, first_ip + offset, size
+        offset += size
+
+def make_batch_tuner(request, job: MappingJob) -> Optional[BatchSizeTuner]:
+    return BatchSizeTuner(request.batch_size, job_id=job.id) if request.auto_batch else None
+
+def make_pipeline(job: MappingJob) -> Optional[PayloadPipeline]:
+    job.pipeline = PayloadPipeline() if PIPELINE_WORKERS > 0 else None
+    return job.pipeline
+
+async def process_mass_mapping(request: MappingRequest, job: MappingJob):
+    dispatcher = None
     try:
-        network = ipaddress.ip_network(request.subnet)
-        total_ips = network.num_addresses
-        logger.info(f"Starting mass mapping for {total_ips} addresses in {request.subnet}")
-        
-        batch = []
-        count = 0
-        total_batches = (total_ips // request.batch_size) + 1
-        
-        for i, ip in enumerate(network.hosts()):
-            batch.append({
-                "name": f"{request.user_prefix}{i+1}",
-                "ip": str(ip),
-                "timeout": request.timeout
-            })
-            
-            if len(batch) == 1:
-                 logger.info(f"Batching started. Current Batch Size Target: {request.batch_size}")
-
-            # Check for cancellation - raise immediately to break the loop
-            if stop_event.is_set():
-                logger.warning("Stop event detected - cancelling operation")
-                raise asyncio.CancelledError()
-
-            if len(batch) >= request.batch_size:
-                logger.info(f"Sending batch of {len(batch)} IPs...")
-                uid_msg = create_uid_message(batch, request.operation)
-                xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
-                
-                # Add cancellation check before network call
-                if stop_event.is_set():
-                    logger.warning("Stop event detected before network call")
-                    raise asyncio.CancelledError()
-                    
-                await send_payload_async(xml_str, request.cert_path, request.uia_url)
-                batch = []
-                count += 1
-                if count % 10 == 0:
-                    logger.info(f"Processed {count}/{total_batches} batches...")
-                # Tiny sleep to avoid slamming the UIA if needed
-                await asyncio.sleep(0.01)
-
-        # Send remaining
-        if batch:
-            uid_msg = create_uid_message(batch, request.operation)
-            xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
-            await send_payload_async(xml_str, request.cert_path, request.uia_url)
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+        dispatcher = AgentDispatcher(agents, mode, request.max_inflight, request.rate_mode,
+                                     request.rate_limit, request.cert_path, job.advance,
+                                     request.max_attempts, job.id, job.record_failure, mapping_state,
+                                     make_batch_tuner(request, job))
+        network, first_ip, total = plan_subnet(request)
+        job.begin(dispatcher.expected_deliveries(total), dispatcher)
+        tuner = dispatcher.tuner
+        total_batches = "?" if tuner else -(-total // max(1, request.batch_size))
+        logger.info(f"[{job.id}] Starting mass mapping for {total} addresses in {request.subnet} from offset {request.start_offset} "
+                    f"to {len(agents)} agent(s), {mode} (window: {request.max_inflight} batches)")
+        logger.info(f"Batching started. Current Batch Size Target: {request.batch_size}{' (auto)' if tuner else ''}")
+
+        batch_size = tuner.next_size if tuner else request.batch_size
+        batches = iter_range_batches(first_ip, total, batch_size)
+        plan_args = lambda batch: (batch[1], batch[2], network.version, request.user_prefix,
+                                   request.start_offset + batch[0] + 1, request.timeout, request.operation,
+                                   len(agents), mode == "shard")
+        index = 0
+        async for (offset, batch_ip, size), parts in plan_batches(batches, plan_args, make_pipeline(job)):
+            # Waits here while paused; raises if the job was stopped
+            await job.checkpoint()
+
+            start = request.start_offset + offset
+            await dispatcher.submit_range(batch_ip, size, network.version, request.user_prefix,
+                                          start + 1, request.timeout, request.operation,
+                                          on_done=functools.partial(job.range_done, index, start + size), parts=parts)
+            index += 1
+            count = index
+            if count % 10 == 0:
+                logger.info(f"Processed {count}/{total_batches} batches... ({dispatcher.rate or 0:.0f} entries/s)")
+        await dispatcher.drain()
             
-        logger.info(f"Mass mapping ({request.operation}) completed successfully.")
+        logger.info(f"[{job.id}] Mass mapping ({request.operation}) completed: {job.current} entries sent, {job.failed} failed")
     except asyncio.CancelledError:
-        logger.warning("Mass mapping was cancelled by user.")
+        if dispatcher:
+            dispatcher.cancel()
+        logger.warning(f"[{job.id}] Mass mapping was cancelled by user.")
         raise
     except Exception as e:
-        logger.error(f"Error in mass mapping: {e}")
-    finally:
-        mapping_in_progress = False
-        active_mapping_task = None
+        if dispatcher:
+            dispatcher.cancel()
+        job.error = str(e)
+        logger.error(f"[{job.id}] Error in mass mapping: {e}")
 
-async def process_bulk_mapping(request: BulkMappingRequest):
+async def process_bulk_mapping(request: BulkMappingRequest, job: MappingJob):
     """Process bulk mapping with count-based entries (not subnet-based)"""
-    global mapping_in_progress, active_mapping_task, progress_current, progress_total
-    stop_event.clear()
-    progress_current = 0
-    progress_total = request.count
+    dispatcher = None
     
     try:
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+        dispatcher = AgentDispatcher(agents, mode, request.max_inflight, request.rate_mode, request.rate_limit,
+                                     on_progress=job.advance, max_attempts=request.max_attempts,
+                                     job_id=job.id, on_failure=job.record_failure, state=mapping_state,
+                                     tuner=make_batch_tuner(request, job))
+        first = max(0, request.start_offset)
+        total = max(0, request.count - first)
+        job.begin(dispatcher.expected_deliveries(total), dispatcher)
+
         # Parse base IP
         base_ip = ipaddress.ip_address(request.base_ip)
-        logger.info(f"Starting bulk mapping: {request.count} entries from {base_ip}")
+        last_ip = base_ip + max(0, request.count - 1)  # Raises if the range runs past the end of the address space
+        logger.info(f"[{job.id}] Starting bulk mapping: {total} entries from {base_ip + first} to {last_ip} "
+                    f"to {len(agents)} agent(s), {mode} (window: {request.max_inflight} batches, "
+                    f"batch: {request.batch_size}{' auto' if dispatcher.tuner else ''})")
         
-        batch = []
-        for i in range(request.count):
-            # Check for cancellation
-            if stop_event.is_set():
-                logger.warning("Bulk mapping cancelled by user")
-                raise asyncio.CancelledError()
-            
-            current_ip = base_ip + i
-            batch.append({
-                "name": f"{request.user_prefix}{i+1}",
-                "ip": str(current_ip),
-                "timeout": request.timeout
-            })
+        batch_size = dispatcher.tuner.next_size if dispatcher.tuner else request.batch_size
+        batches = iter_range_batches(int(base_ip) + first, total, batch_size)
+        plan_args = lambda batch: (batch[1], batch[2], base_ip.version, request.user_prefix, first + batch[0] + 1,
+                                   request.timeout, request.operation, len(agents), mode == "shard")
+        index = 0
+        async for (offset, batch_ip, size), parts in plan_batches(batches, plan_args, make_pipeline(job)):
+            # Waits here while paused; raises if the job was stopped
+            await job.checkpoint()
             
-            if len(batch) >= INTERNAL_BATCH_SIZE:
-                # Check again before network call
-                if stop_event.is_set():
-                    raise asyncio.CancelledError()
-                
-                logger.info(f"Sending batch... ({progress_current + len(batch)} of {progress_total})")
-                uid_msg = create_uid_message(batch, request.operation)
-                xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
-                await send_payload_async(xml_str, "", request.uia_url)
-                
-                progress_current += len(batch)
-                batch = []
-                
-                # Rate limiting: pause every 1000 entries to avoid overwhelming UIA
-                if progress_current % 1000 == 0:
-                    logger.info(f"Rate limit pause at {progress_current} entries...")
-                    await asyncio.sleep(2.0)
-                else:
-                    await asyncio.sleep(0.01)  # Small yield
+            start = first + offset
+            logger.info(f"[{job.id}] Sending batch... ({start + size} of {request.count})")
+            await dispatcher.submit_range(batch_ip, size, base_ip.version, request.user_prefix,
+                                          start + 1, request.timeout, request.operation,
+                                          on_done=functools.partial(job.range_done, index, start + size), parts=parts)
+            index += 1
+        await dispatcher.drain()
         
-        # Send remaining
-        if batch:
-            if stop_event.is_set():
-                raise asyncio.CancelledError()
-            uid_msg = create_uid_message(batch, request.operation)
-            xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
-            await send_payload_async(xml_str, "", request.uia_url)
-            progress_current += len(batch)
-        
-        logger.info(f"Bulk mapping completed: {progress_current} entries sent")
+        logger.info(f"[{job.id}] Bulk mapping completed: {job.current} entries sent, {job.failed} failed")
+    except asyncio.CancelledError:
+        if dispatcher:
+            dispatcher.cancel()
+        logger.warning(f"[{job.id}] Bulk mapping cancelled")
+        raise
+    except Exception as e:
+        if dispatcher:
+            dispatcher.cancel()
+        job.error = str(e)
+        logger.error(f"[{job.id}] Error in bulk mapping: {e}")
+
+# Tag job target -> (log label, payload builder, shard key)
+TAG_TARGETS = {
+    "ip": ("DAG", build_ip_tag_payload, lambda item, n: shard_for_ip(item["ip"], n)),
+    "user": ("DUG", build_tag_payload, lambda item, n: shard_for_user(item["user"], n)),
+}
+
+async def spool_upload(chunks, suffix: str) -> str:
+    """Write a streamed request body to UPLOAD_DIR chunk by chunk; returns the file path"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.{suffix}")
+    with open(path, "wb") as f:
+        async for chunk in chunks:
+            f.write(chunk)
+    return path
+
+def spool_items(items: List[dict]) -> str:
+    """Spool an already-parsed item list as NDJSON so it can run (and resume) like an upload"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.ndjson")
+    with open(path, "w") as f:
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+    return path
+
+def iter_upload_rows(path: str, fmt: str):
+    """Yield (line number, row dict) from an NDJSON or CSV (with header) upload"""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+            return
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_num, row if isinstance(row, dict) else None
+
+def iter_tag_items(path: str, fmt: str, target: str, default_tag: Optional[str] = None, on_invalid=None):
+    """Yield valid {target: ..., "tag": ...} items; invalid rows are reported to on_invalid and skipped"""
+    for line_num, row in iter_upload_rows(path, fmt):
+        value = row.get(target) if row else None
+        tag = (row.get("tag") if row else None) or default_tag
+        if target == "ip" and value:
+            try:
+                value = str(ipaddress.ip_address(value))
+            except ValueError:
+                value = None
+        if not value or not tag:
+            if on_invalid:
+                on_invalid(line_num)
+            continue
+        yield {target: value, "tag": tag}
+
+def iter_chunks(items, size: int):
+    """Group an iterator into lists of at most size items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def validate_mapping_rows(rows, default_timeout: int):
+    """Validate a block of (line number, row) pairs in one pass; returns (entries, invalid line numbers)"""
+    entries, invalid = [], []
+    ip_address = ipaddress.ip_address
+    for line_num, row in rows:
+        if not row:
+            invalid.append(line_num)
+            continue
+        user = row.get("user") or row.get("username") or row.get("name")
+        timeout = row.get("timeout") or default_timeout
+        try:
+            ip = str(ip_address(row.get("ip") or ""))
+            timeout = int(timeout)
+        except (TypeError, ValueError):
+            invalid.append(line_num)
+            continue
+        if not user:
+            invalid.append(line_num)
+            continue
+        entries.append({"name": str(user), "ip": ip, "timeout": timeout})
+    return entries, invalid
+
+def iter_mapping_batches(path: str, fmt: str, default_timeout: int, batch_size: int, on_invalid=None):
+    """Yield lists of up to batch_size valid {name, ip, timeout} entries from an upload"""
+    pending = []
+    for block in iter_chunks(iter_upload_rows(path, fmt), max(1, batch_size)):
+        entries, invalid = validate_mapping_rows(block, default_timeout)
+        if on_invalid:
+            for line_num in invalid:
+                on_invalid(line_num)
+        pending.extend(entries)
+        while len(pending) >= batch_size:
+            yield pending[:batch_size]
+            pending = pending[batch_size:]
+    if pending:
+        yield pending
+
+def scan_mapping_upload(request: MappingImportRequest):
+    """Validation pass over a whole upload: (valid row count, invalid line numbers)"""
+    invalid = []
+    valid = sum(len(batch) for batch in iter_mapping_batches(request.source, request.format, request.timeout,
+                                                             request.batch_size, invalid.append))
+    return valid, invalid
+
+def count_tag_items(request: TagJobRequest) -> int:
+    return sum(1 for _ in iter_tag_items(request.source, request.format, request.target, request.tag))
+
+async def process_tag_job(request: TagJobRequest, job: MappingJob):
+    """Send a spooled DAG/DUG tag list in batches through the same windows as bulk mapping"""
+    dispatcher = None
+    interrupted = False
+    kind, build, shard_key = TAG_TARGETS[request.target]
+    try:
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+        dispatcher = AgentDispatcher(agents, mode, request.max_inflight, request.rate_mode,
+                                     request.rate_limit, request.cert_path, job.advance,
+                                     request.max_attempts, job.id, job.record_failure)
+        first = max(0, request.start_offset)
+        total = max(0, await asyncio.to_thread(count_tag_items, request) - first)
+        job.begin(dispatcher.expected_deliveries(total), dispatcher)
+        logger.info(f"[{job.id}] Starting {kind} update: {total} entries, action={request.action}, "
+                    f"to {len(agents)} agent(s), {mode} (batch: {request.batch_size})")
+
+        invalid = []
+        items = iter_tag_items(request.source, request.format, request.target, request.tag, invalid.append)
+        for _ in range(first):
+            next(items, None)
+        start = first
+        for index, chunk in enumerate(iter_chunks(items, max(1, request.batch_size))):
+            # Waits here while paused; raises if the job was stopped
+            await job.checkpoint()
+            await dispatcher.submit_items(chunk, build, request.action, shard_key,
+                                          on_done=functools.partial(job.range_done, index, start + len(chunk)))
+            start += len(chunk)
+        await dispatcher.drain()
+        if invalid:
+            logger.warning(f"[{job.id}] Skipped {len(invalid)} invalid row(s), first at line {invalid[0]}")
+        logger.info(f"[{job.id}] {kind} update completed: {job.current} entries sent, {job.failed} failed")
+    except asyncio.CancelledError:
+        if dispatcher:
+            dispatcher.cancel()
+        # Shutdown (not a user cancel): keep the upload so the job can resume
+        interrupted = not job._stop
+        logger.warning(f"[{job.id}] {kind} update cancelled")
+        raise
+    except Exception as e:
+        if dispatcher:
+            dispatcher.cancel()
+        job.error = str(e)
+        logger.error(f"[{job.id}] Error in {kind} update: {e}")
+    finally:
+        if not interrupted and os.path.exists(request.source):
+            os.remove(request.source)
+
+async def process_mapping_import(request: MappingImportRequest, job: MappingJob):
+    """Send an uploaded mapping file in batches, the same way as process_bulk_mapping"""
+    dispatcher = None
+    interrupted = False
+    try:
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+        dispatcher = AgentDispatcher(agents, mode, request.max_inflight, request.rate_mode,
+                                     request.rate_limit, request.cert_path, job.advance,
+                                     request.max_attempts, job.id, job.record_failure, mapping_state)
+        valid, invalid = await asyncio.to_thread(scan_mapping_upload, request)
+        if invalid:
+            logger.warning(f"[{job.id}] Skipping {len(invalid)} invalid row(s), lines: "
+                           f"{', '.join(map(str, invalid[:10]))}{' ...' if len(invalid) > 10 else ''}")
+        first = max(0, request.start_offset)
+        total = max(0, valid - first)
+        job.begin(dispatcher.expected_deliveries(total), dispatcher)
+        logger.info(f"[{job.id}] Starting mapping import: {total} entries, {request.operation}, "
+                    f"to {len(agents)} agent(s), {mode} (window: {request.max_inflight} batches)")
+
+        batch_size = max(1, request.batch_size)
+        start = 0
+        index = 0
+        for batch in iter_mapping_batches(request.source, request.format, request.timeout, batch_size):
+            if start + len(batch) <= first:
+                start += len(batch)  # Already acknowledged before a restart
+                continue
+            batch = batch[max(0, first - start):]
+            start = max(start, first)
+            # Waits here while paused; raises if the job was stopped
+            await job.checkpoint()
+            await dispatcher.submit_items(batch, build_uid_payload, request.operation,
+                                          lambda entry, n: shard_for_ip(entry["ip"], n),
+                                          on_done=functools.partial(job.range_done, index, start + len(batch)))
+            start += len(batch)
+            index += 1
+        await dispatcher.drain()
+
+        logger.info(f"[{job.id}] Mapping import completed: {job.current} entries sent, {job.failed} failed")
     except asyncio.CancelledError:
-        logger.warning("Bulk mapping cancelled")
+        if dispatcher:
+            dispatcher.cancel()
+        # Shutdown (not a user cancel): keep the upload so the job can resume
+        interrupted = not job._stop
+        logger.warning(f"[{job.id}] Mapping import cancelled")
         raise
     except Exception as e:
-        logger.error(f"Error in bulk mapping: {e}")
+        if dispatcher:
+            dispatcher.cancel()
+        job.error = str(e)
+        logger.error(f"[{job.id}] Error in mapping import: {e}")
     finally:
-        mapping_in_progress = False
-        active_mapping_task = None
+        if not interrupted and os.path.exists(request.source):
+            os.remove(request.source)
+
+def diff_mapping_upload(request: MappingSyncRequest, agents: List[str], mode: str, out_path: str):
+    """Write desired mappings the agents do not already hold to out_path; returns (count, seen IPs, invalid)"""
+    horizon = time.time() + request.refresh_margin
+    agent_count = len(agents)
+    seen, invalid = set(), []
+    count = 0
+    with open(out_path, "w") as out:
+        if request.source:
+            for batch in iter_mapping_batches(request.source, request.format, request.timeout,
+                                              request.batch_size, invalid.append):
+                for entry in batch:
+                    ip = int(ipaddress.ip_address(entry["ip"]))
+                    seen.add(ip)
+                    targets = [agents[ip % agent_count]] if mode == "shard" else agents
+                    if all(mapping_state.is_current(url, ip, entry["name"], horizon) for url in targets):
+                        continue
+                    out.write(json.dumps(entry) + "\n")
+                    count += 1
+    return count, seen, invalid
+
+async def process_mapping_sync(request: MappingSyncRequest, job: MappingJob):
+    """Send only the difference between the mapping state and a desired set (or log out everything known)"""
+    dispatcher = None
+    interrupted = False
+    diff_path = os.path.join(UPLOAD_DIR, f"{job.id}.diff.ndjson")
+    try:
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+        dispatcher = AgentDispatcher(agents, mode, request.max_inflight, request.rate_mode,
+                                     request.rate_limit, request.cert_path, job.advance,
+                                     request.max_attempts, job.id, job.record_failure, mapping_state)
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        logins, seen, invalid = await asyncio.to_thread(diff_mapping_upload, request, agents, mode, diff_path)
+        if invalid:
+            logger.warning(f"[{job.id}] Skipping {len(invalid)} invalid row(s), lines: "
+                           f"{', '.join(map(str, invalid[:10]))}{' ...' if len(invalid) > 10 else ''}")
+        logouts = mapping_state.missing(agents, seen) if request.prune else {}
+        logout_count = sum(len(entries) for entries in logouts.values())
+        job.begin(dispatcher.expected_deliveries(logins) + logout_count, dispatcher)
+        logger.info(f"[{job.id}] Mapping sync: {logins} to log in, {logout_count} to log out, "
+                    f"{len(seen) - logins} unchanged, on {len(agents)} agent(s), {mode}")
+
+        batch_size = max(1, request.batch_size)
+        shard_key = lambda entry, n: shard_for_ip(entry["ip"], n)
+        # Logins go out like any import; each logout goes only to the agent known to hold the mapping
+        batches = itertools.chain(
+            ((None, batch) for batch in iter_mapping_batches(diff_path, "ndjson", request.timeout, batch_size)),
+            ((url, batch) for url, entries in logouts.items() for batch in iter_chunks(entries, batch_size)))
+        start = 0
+        for index, (url, batch) in enumerate(batches):
+            # Waits here while paused; raises if the job was stopped
+            await job.checkpoint()
+            on_done = functools.partial(job.range_done, index, start + len(batch))
+            if url is None:
+                await dispatcher.submit_items(batch, build_uid_payload, "login", shard_key, on_done=on_done)
+            else:
+                await dispatcher.submit_agent_items(url, batch, build_uid_payload, "logout", on_done=on_done)
+            start += len(batch)
+        await dispatcher.drain()
+
+        logger.info(f"[{job.id}] Mapping sync completed: {job.current} entries sent, {job.failed} failed")
+    except asyncio.CancelledError:
+        if dispatcher:
+            dispatcher.cancel()
+        # Shutdown (not a user cancel): keep the upload so the job can resume
+        interrupted = not job._stop
+        logger.warning(f"[{job.id}] Mapping sync cancelled")
+        raise
+    except Exception as e:
+        if dispatcher:
+            dispatcher.cancel()
+        job.error = str(e)
+        logger.error(f"[{job.id}] Error in mapping sync: {e}")
+    finally:
+        if os.path.exists(diff_path):
+            os.remove(diff_path)
+        if not interrupted and request.source and os.path.exists(request.source):
+            os.remove(request.source)
+
+# Mapping Refresh
+
+class RefreshScheduler:
+    """Resends known mappings shortly before they expire on the agent.
+
+    Each login is scheduled at a random point in the last REFRESH_SPREAD of its
+    timeout (but at least REFRESH_MARGIN before expiry), so a population logged
+    in at once drifts apart instead of expiring - and refreshing - together.
+    """
+
+    def __init__(self, state: MappingState, margin: float = REFRESH_MARGIN, spread: float = REFRESH_SPREAD,
+                 batch_size: int = REFRESH_BATCH_SIZE, tick: float = REFRESH_TICK):
+        self.state = state
+        self.margin = margin
+        self.spread = spread
+        self.batch_size = max(1, batch_size)
+        self.tick = tick
+        self.refreshed = 0
+        self.last_error = None
+        self.dispatchers = {}  # url -> AgentDispatcher
+        self._heap = []  # (refresh_at, expiry, url, ip)
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def schedule(self, url: str, ip: int, timeout, expiry: float):
+        latest = expiry - min(self.margin, timeout / 2)
+        refresh_at = latest - random.random() * self.spread * timeout
+        heapq.heappush(self._heap, (refresh_at, expiry, url, ip))
+
+    def start(self):
+        if self.running:
+            return
+        self._heap = []
+        for url, table in self.state.agents.items():
+            for ip, (_, timeout, expiry) in table.items():
+                self.schedule(url, ip, timeout, expiry)
+        self.state.on_login = self.schedule
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Refresh scheduler started: {len(self._heap)} mappings tracked")
+
+    def stop(self):
+        self.state.on_login = None
+        self._heap = []
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for dispatcher in self.dispatchers.values():
+            dispatcher.cancel()
+        self.dispatchers = {}
+        logger.info("Refresh scheduler stopped")
+
+    def _due(self, now: float) -> dict:
+        """Pop every mapping due for refresh that is still current: {url: [entry, ...]}"""
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, expiry, url, ip = heapq.heappop(self._heap)
+            known = self.state.agents.get(url, {}).get(ip)
+            if known is None or known[2] != expiry:
+                continue  # Logged out, or refreshed by some other run since it was scheduled
+            user, timeout, _ = known
+            due.setdefault(url, []).append({"name": user, "ip": str(ipaddress.ip_address(ip)), "timeout": timeout})
+        return due
+
+    def _dispatcher(self, url: str):
+        if url not in self.dispatchers:
+            self.dispatchers[url] = AgentDispatcher([url], "broadcast", DEFAULT_MAX_INFLIGHT, RATE_MODE, None,
+                                                    on_progress=self._on_ack, job_id="refresh", state=self.state)
+        return self.dispatchers[url]
+
+    def _on_ack(self, count: int):
+        self.refreshed += count
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.tick)
+                try:
+                    await self._refresh_due()
+                except Exception as e:
+                    # One bad pass must not end refreshing for every mapping scheduled after it
+                    self.last_error = str(e)
+                    logger.error(f"Refresh pass failed: {e}")
+        finally:
+            if self._task is asyncio.current_task():  # Not stop(): it clears _task first
+                self.state.on_login = None
+                self._task = None
+                logger.error("Refresh scheduler stopped unexpectedly")
+
+    async def _refresh_due(self):
+        for url, entries in self._due(time.time()).items():
+            logger.info(f"Refreshing {len(entries)} mapping(s) on {url}")
+            dispatcher = self._dispatcher(url)
+            for batch in iter_chunks(entries, self.batch_size):
+                await dispatcher.submit_agent_items(url, batch, build_uid_payload, "login")
+
+    def to_dict(self):
+        return {
+            "running": self.running,
+            "scheduled": len(self._heap),
+            "next_refresh_in": round(max(0.0, self._heap[0][0] - time.time()), 1) if self._heap else None,
+            "refreshed": self.refreshed,
+            "last_error": self.last_error,
+            "agents": {url: dispatcher.stats[url] for url, dispatcher in self.dispatchers.items()},
+        }
+
+refresh_scheduler = RefreshScheduler(mapping_state)
+
+# Job kind -> (request model, engine), used to rebuild jobs from the journal. Sync (and logout-all) jobs are
+# left out: their diff is taken against mapping state that is not persisted, so an offset into it means nothing
+# after a restart; they are not journaled and never show up as interrupted
+JOB_ENGINES = {
+    "bulk": (BulkMappingRequest, process_bulk_mapping),
+    "subnet": (MappingRequest, process_mass_mapping),
+    "tags": (TagJobRequest, process_tag_job),
+    "import": (MappingImportRequest, process_mapping_import),
+}
+
+def resume_interrupted_job(job_id: str) -> MappingJob:
+    record = interrupted_jobs.pop(job_id)
+    save_interrupted_jobs()
+    model, engine = JOB_ENGINES[record["kind"]]
+    spec = dict(record["spec"], start_offset=record["offset"])
+    if spec.get("max_count") is not None:
+        # max_count counts from the job's own start_offset: take off what was acknowledged before the restart
+        done = record["offset"] - record["spec"].get("start_offset", 0)
+        spec["max_count"] = max(0, spec["max_count"] - done)
+    group = record.get("group")
+    if group and group["name"] not in agent_groups:
+        agent_groups[group["name"]] = AgentGroupRequest(**group)
+        save_agent_groups()
+    logger.info(f"[{job_id}] Resuming {record['kind']} job from offset {record['offset']}")
+    return job_manager.submit(record["kind"], model(**spec), engine, job_id=job_id)
+
+@app.on_event("startup")
+async def load_journal():
+    if state_store.shared:
+        load_shared_config()
+        state_sync.start()
+    if state_store.claim("journal"):
+        # Jobs still running on live workers are in the journal too, but not interrupted
+        running = {s["job_id"] for s in state_store.list_jobs() if s["running"]}
+        for job_id, record in journal.load().items():
+            if record["kind"] not in JOB_ENGINES:
+                journal.end(job_id, "discarded")  # Sync job journaled by an earlier version
+            elif job_id not in running:
+                interrupted_jobs[job_id] = record
+        save_interrupted_jobs()
+        if interrupted_jobs:
+            logger.warning(f"Journal: {len(interrupted_jobs)} interrupted job(s) found")
+        if RESUME_JOBS_ON_STARTUP:
+            for job_id in list(interrupted_jobs):
+                resume_interrupted_job(job_id)
+    if REFRESH_ENABLED and WORKERS > 1:
+        logger.error(f"REFRESH_ENABLED ignored: with WORKERS={WORKERS} each worker only knows the mappings it sent, "
+                     f"so the others' would expire; run a single worker to keep mappings alive")
+    elif REFRESH_ENABLED:
+        refresh_scheduler.start()
+
+@app.on_event("shutdown")
+async def flush_journal():
+    journal.sync()
+    await state_sync.stop()
+    if payload_pool is not None:
+        payload_pool.shutdown(wait=False, cancel_futures=True)
+    if payload_cache is not None:
+        payload_cache.seal()
 
 # Endpoints
 @app.post("/single-mapping")
 async def single_mapping(request: SingleMappingRequest):
     """Send a single IP-User mapping"""
+    try:
+        ipaddress.ip_address(request.ip)  # Checked before sending: the mapping state can't track it otherwise
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid IP address: {request.ip}")
     entry = [{
         "name": request.username,
         "ip": request.ip,
         "timeout": request.timeout
     }]
-    uid_msg = create_uid_message(entry, request.operation)
-    xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
     logger.info(f"Sending single mapping: {request.ip} -> {request.username} ({request.operation})")
-    result = await send_payload_async(xml_str, "", request.uia_url)
+    coalesce = SINGLE_BATCH if request.coalesce is None else request.coalesce
+    if coalesce:
+        result = await single_batcher.send(request.uia_url, request.operation, entry[0])
+    else:
+        result = await send_payload_async(build_uid_payload(entry, request.operation), "", request.uia_url)
+    if result.get("rejected"):
+        result = {"error": f"UIA Agent rejected entry: {result['rejected'][0]['message']}"}
     if "error" in result:
         raise HTTPException(status_code=500, detail=result["error"])
+    mapping_state.record(request.uia_url, item_entries(entry), request.operation)
     return {"message": f"Single {request.operation} sent for {request.ip}", "result": result}
 
 @app.post("/bulk-mapping")
 async def bulk_mapping(request: BulkMappingRequest):
     """Start bulk mapping with count-based entries"""
-    global active_mapping_task, mapping_in_progress
-    if mapping_in_progress:
-        raise HTTPException(status_code=400, detail="A mapping task is already in progress.")
-    mapping_in_progress = True
-    active_mapping_task = asyncio.create_task(process_bulk_mapping(request))
-    return {"message": f"Started bulk mapping for {request.count} entries."}
+    try:
+        make_rate_controller(request.rate_mode, request.rate_limit)
+        resolve_agents(request.uia_url, request.agent_group)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = job_manager.submit("bulk", request, process_bulk_mapping)
+    return {"message": f"Started bulk mapping for {request.count} entries.", "job_id": job.id}
 
 @app.get("/progress")
-async def get_progress():
-    """Get current progress of bulk operation"""
-    return {
-        "current": progress_current,
-        "total": progress_total,
-        "running": mapping_in_progress
-    }
+async def get_progress(job_id: Optional[str] = None):
+    """Get progress of a job (default: the most recently started one)"""
+    progress = job_snapshot(job_id) if job_id else latest_job_snapshot()
+    return progress or {"current": 0, "total": 0, "running": False}
 
 @app.post("/map-subnet")
 async def map_subnet(request: MappingRequest):
-    global active_mapping_task, mapping_in_progress
-    if mapping_in_progress:
-        raise HTTPException(status_code=400, detail="A mapping task is already in progress.")
-    mapping_in_progress = True
-    active_mapping_task = asyncio.create_task(process_mass_mapping(request))
-    return {"message": "Started mass mapping. Tracking progress on dashboard."}
+    try:
+        make_rate_controller(request.rate_mode, request.rate_limit)
+        resolve_agents(request.uia_url, request.agent_group)
+        plan_subnet(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = job_manager.submit("subnet", request, process_mass_mapping)
+    return {"message": "Started mass mapping. Tracking progress on dashboard.", "job_id": job.id}
+
+@app.post("/import-mappings")
+async def import_mappings(http_request: Request, operation: str = "login", timeout: int = 3600,
+                          uia_url: Optional[str] = None, agent_group: Optional[str] = None,
+                          format: Optional[str] = None, batch_size: int = INTERNAL_BATCH_SIZE,
+                          max_inflight: int = DEFAULT_MAX_INFLIGHT, rate_mode: str = RATE_MODE,
+                          rate_limit: Optional[float] = None, max_attempts: int = RETRY_MAX_ATTEMPTS,
+                          cert_path: str = "certs/uia-client-bundle.pem"):
+    """IP-user mappings from a streamed body: NDJSON {"ip", "user", "timeout"} lines or CSV with those columns"""
+    if format is None:
+        format = "csv" if "csv" in http_request.headers.get("content-type", "") else "ndjson"
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    try:
+        make_rate_controller(rate_mode, rate_limit)
+        resolve_agents(uia_url, agent_group)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    source = await spool_upload(http_request.stream(), format)
+    logger.info(f"Mapping import spooled: {os.path.getsize(source)} bytes, operation={operation}")
+    request = MappingImportRequest(source=source, format=format, operation=operation, timeout=timeout,
+                                   uia_url=uia_url, agent_group=agent_group, cert_path=cert_path,
+                                   batch_size=batch_size, max_inflight=max_inflight, rate_mode=rate_mode,
+                                   rate_limit=rate_limit, max_attempts=max_attempts)
+    job = job_manager.submit("import", request, process_mapping_import)
+    return {"message": "Mapping import started in background.", "job_id": job.id}
+
+def require_local_mapping_state(action: str):
+    """Mapping state lives in each worker's memory: with several workers none of them knows every mapping"""
+    if WORKERS > 1:
+        raise HTTPException(status_code=409, detail=f"{action} needs every known mapping, but with WORKERS={WORKERS} "
+                                                     f"each worker only knows the ones it sent; run a single worker")
+
+@app.get("/mappings")
+async def get_mapping_state():
+    """Mappings each agent has acknowledged, as far as this app knows"""
+    require_local_mapping_state("Listing mappings")
+    return {"agents": mapping_state.summary(), "max_entries": mapping_state.max_entries}
+
+@app.delete("/mappings")
+async def forget_mapping_state(uia_url: Optional[str] = None):
+    """Forget known mappings (all, or one agent's) without logging anything out"""
+    require_local_mapping_state("Forgetting mappings")
+    mapping_state.forget(uia_url)
+    return {"message": f"Mapping state cleared for {uia_url or 'all agents'}."}
+
+@app.post("/mappings/sync")
+async def sync_mappings(http_request: Request, timeout: int = 3600, prune: bool = True, refresh_margin: int = 300,
+                        uia_url: Optional[str] = None, agent_group: Optional[str] = None,
+                        format: Optional[str] = None, batch_size: int = INTERNAL_BATCH_SIZE,
+                        max_inflight: int = DEFAULT_MAX_INFLIGHT, rate_mode: str = RATE_MODE,
+                        rate_limit: Optional[float] = None, max_attempts: int = RETRY_MAX_ATTEMPTS,
+                        cert_path: str = "certs/uia-client-bundle.pem"):
+    """Make the agents match a streamed desired set (NDJSON/CSV ip,user,timeout), sending only the diff"""
+    require_local_mapping_state("Mapping sync")
+    if format is None:
+        format = "csv" if "csv" in http_request.headers.get("content-type", "") else "ndjson"
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    try:
+        make_rate_controller(rate_mode, rate_limit)
+        resolve_agents(uia_url, agent_group)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    source = await spool_upload(http_request.stream(), format)
+    request = MappingSyncRequest(source=source, format=format, timeout=timeout, prune=prune,
+                                 refresh_margin=refresh_margin, uia_url=uia_url, agent_group=agent_group,
+                                 cert_path=cert_path, batch_size=batch_size, max_inflight=max_inflight,
+                                 rate_mode=rate_mode, rate_limit=rate_limit, max_attempts=max_attempts)
+    job = job_manager.submit("sync", request, process_mapping_sync)
+    return {"message": "Mapping sync started in background.", "job_id": job.id}
+
+@app.post("/mappings/logout-all")
+async def logout_known_mappings(request: MappingSyncRequest):
+    """Log out every mapping the app has logged in on these agents"""
+    require_local_mapping_state("Logout-all")
+    try:
+        make_rate_controller(request.rate_mode, request.rate_limit)
+        resolve_agents(request.uia_url, request.agent_group)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    request = request.model_copy(update={"source": None, "prune": True})
+    job = job_manager.submit("sync", request, process_mapping_sync)
+    return {"message": "Logging out all known mappings in background.", "job_id": job.id}
+
+@app.get("/refresh")
+async def get_refresh_status():
+    return refresh_scheduler.to_dict()
+
+@app.post("/refresh/start")
+async def start_refresh():
+    """Keep every known mapping alive by resending it shortly before it expires"""
+    require_local_mapping_state("Mapping refresh")
+    refresh_scheduler.start()
+    return refresh_scheduler.to_dict()
+
+@app.post("/refresh/stop")
+async def stop_refresh():
+    refresh_scheduler.stop()
+    return refresh_scheduler.to_dict()
+
+@app.get("/jobs")
+async def list_jobs():
+    return {"jobs": all_job_snapshots()}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return job_snapshot(job_id)
+
+def forward_command(job_id: str, action: str, required_status: Optional[str] = None):
+    """Hand a control action for another worker's job to that worker; returns the response, or None if local"""
+    snapshot = remote_job(job_id)
+    if snapshot is None:
+        return None
+    if required_status and snapshot["status"] != required_status:
+        raise HTTPException(status_code=400, detail=f"Job {job_id} is {snapshot['status']}, not {required_status}.")
+    state_store.send_command(snapshot["worker"], job_id, action)
+    return {"message": f"Job {job_id} {action} sent to worker {snapshot['worker']}."}
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    forwarded = forward_command(job_id, "cancel")
+    if forwarded:
+        return forwarded
+    job = job_manager.get(job_id)
+    job.cancel()
+    logger.warning(f"[{job_id}] Cancelling job...")
+    return {"message": f"Job {job_id} cancelled."}
+
+@app.post("/jobs/{job_id}/pause")
+async def pause_job(job_id: str):
+    forwarded = forward_command(job_id, "pause", "running")
+    if forwarded:
+        return forwarded
+    job = job_manager.get(job_id)
+    if job.status != "running":
+        raise HTTPException(status_code=400, detail=f"Job {job_id} is {job.status}, not running.")
+    job.pause()
+    return {"message": f"Job {job_id} paused."}
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    forwarded = forward_command(job_id, "resume", "paused")
+    if forwarded:
+        return forwarded
+    job = job_manager.get(job_id)
+    if job.status != "paused":
+        raise HTTPException(status_code=400, detail=f"Job {job_id} is {job.status}, not paused.")
+    job.resume()
+    return {"message": f"Job {job_id} resumed."}
+
+@app.get("/interrupted-jobs")
+async def list_interrupted_jobs():
+    """Jobs that were still running when the app last stopped"""
+    load_interrupted_jobs()
+    return {"jobs": list(interrupted_jobs.values())}
+
+@app.post("/interrupted-jobs/{job_id}/resume")
+async def resume_job_from_journal(job_id: str):
+    load_interrupted_jobs()
+    if job_id not in interrupted_jobs:
+        raise HTTPException(status_code=404, detail=f"No interrupted job {job_id}")
+    job = resume_interrupted_job(job_id)
+    return {"message": f"Job {job_id} resumed from offset {job.acked_offset}.", "job_id": job.id}
+
+@app.delete("/interrupted-jobs/{job_id}")
+async def discard_interrupted_job(job_id: str):
+    load_interrupted_jobs()
+    record = interrupted_jobs.pop(job_id, None)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"No interrupted job {job_id}")
+    save_interrupted_jobs()
+    source = record["spec"].get("source")
+    if source and os.path.exists(source):
+        os.remove(source)
+    journal.end(job_id, "discarded")
+    return {"message": f"Interrupted job {job_id} discarded."}
+
+@app.get("/dead-letters")
+async def list_dead_letters(job_id: Optional[str] = None):
+    """Batches that failed every retry (payloads omitted)"""
+    records = [r for r in dead_letters.load() if not job_id or r["job"] == job_id]
+    return {
+        "count": len(records),
+        "entries": sum(r["count"] for r in records),
+        "batches": [{k: v for k, v in r.items() if k != "payload"} for r in records]
+    }
+
+@app.post("/dead-letters/replay")
+async def replay_dead_letters(job_id: Optional[str] = None):
+    """Resend dead-lettered batches; the ones that get through are removed from the file"""
+    records, claim = dead_letters.claim(job_id)
+    logger.info(f"Replaying {len(records)} dead-lettered batch(es)")
+    policy = RetryPolicy()
+    slots = asyncio.Semaphore(DEFAULT_MAX_INFLIGHT)
+
+    async def replay(record):
+        async with slots:
+            return await send_with_retry(policy, send_payload_async, record["payload"], record["cert_path"], record["agent"])
+
+    try:
+        results = await asyncio.gather(*(replay(r) for r in records))
+    except BaseException:
+        dead_letters.release(claim, records)
+        raise
+    for result in results:
+        if result.get("rejected"):  # Entries the agent still refuses keep the record
+            result["error"] = f"Rejected by agent: {result['rejected'][0]['message']}"
+    delivered = [r["id"] for r, result in zip(records, results) if "error" not in result]
+    dead_letters.release(claim, [r for r, result in zip(records, results) if "error" in result])
+    failed = {r["id"]: result["error"] for r, result in zip(records, results) if "error" in result}
+    logger.info(f"Dead-letter replay: {len(delivered)} delivered, {len(failed)} still failing")
+    return {"delivered": len(delivered), "failed": failed}
+
+@app.delete("/dead-letters")
+async def clear_dead_letters(job_id: Optional[str] = None):
+    records = [r for r in dead_letters.load() if not job_id or r["job"] == job_id]
+    dead_letters.remove(r["id"] for r in records)
+    return {"message": f"Discarded {len(records)} dead-lettered batch(es)."}
+
+@app.get("/payload-cache")
+async def get_payload_cache_status():
+    cache = get_payload_cache()
+    return cache.to_dict() if cache else {"enabled": False}
+
+@app.delete("/payload-cache")
+async def clear_payload_cache():
+    cache = get_payload_cache()
+    if not cache:
+        raise HTTPException(status_code=400, detail="Payload cache is disabled (PAYLOAD_CACHE_MB=0)")
+    return {"message": f"Discarded {cache.clear()} cached payload(s)."}
+
+def cancel_remote_jobs():
+    """Ask the other workers to cancel their active jobs"""
+    for snapshot in state_store.list_jobs():
+        if snapshot["running"] and snapshot["job_id"] not in job_manager.jobs:
+            state_store.send_command(snapshot["worker"], snapshot["job_id"], "cancel")
 
 @app.post("/stop-mapping")
 async def stop_mapping():
-    global active_mapping_task
-    stop_event.set()
-    if active_mapping_task and not active_mapping_task.done():
-        active_mapping_task.cancel()
-        logger.warning("Cancelling active mapping task...")
+    """Stop every active job"""
+    for job in job_manager.active():
+        job.cancel()
+        logger.warning(f"[{job.id}] Cancelling active mapping task...")
+    cancel_remote_jobs()
     return {"message": "Stop signal sent and task cancelled."}
 
 @app.post("/emergency-stop")
 async def emergency_stop():
     """Force stop all operations and reset state"""
-    global mapping_in_progress, config_verified, active_mapping_task
-    stop_event.set()
-    if active_mapping_task and not active_mapping_task.done():
-        active_mapping_task.cancel()
-        logger.warning("Force cancelling active task...")
-        try:
-            await asyncio.wait_for(active_mapping_task, timeout=2.0)
-        except (asyncio.CancelledError, asyncio.TimeoutError):
-            pass
-    mapping_in_progress = False
-    active_mapping_task = None
+    jobs = job_manager.active()
+    for job in jobs:
+        job.cancel()
+    cancel_remote_jobs()
+    if jobs:
+        logger.warning(f"Force cancelling {len(jobs)} active job(s)...")
+        await asyncio.wait([job.task for job in jobs], timeout=2.0)
+    if refresh_scheduler.running:
+        refresh_scheduler.stop()
     logger.warning("EMERGENCY STOP: All operations halted.")
     return {"message": "All operations halted. State reset."}
 
 @app.get("/status")
 async def get_system_status():
+    load_shared_config()
+    active = [s for s in all_job_snapshots() if s["running"]]
     return {
         "status": "online",
-        "mapping_active": mapping_in_progress,
+        "mapping_active": bool(active),
+        "active_jobs": len(active),
         "config_verified": config_verified,
         "uia_url": configured_uia_url
     }
@@ -465,50 +3423,226 @@ async def test_connection(request: ConnectionTestRequest):
         logger.warning(f"Bypassing verification as requested by user for {request.uia_url}")
         configured_uia_url = request.uia_url
         config_verified = True
+        save_connection_config()
         return {"message": "Configuration saved (Verification bypassed)."}
 
     result = await test_uia_connection(request.uia_url)
     
     if "error" in result:
         config_verified = False
+        save_connection_config()
         err_detail = f"[{result.get('stage', 'Unknown')}] {result['error']}"
         logger.error(f"Verification failed: {err_detail}")
         raise HTTPException(status_code=500, detail=err_detail)
     
     configured_uia_url = request.uia_url
     config_verified = True
+    save_connection_config()
     return {"message": "Configuration verified and saved."}
 
 @app.get("/get-logs")
-async def get_logs():
+async def get_logs(since: int = 0):
+    """Buffered log lines; with since, only lines after that sequence number"""
+    lines, seq = logs_since(since)
+    return {"logs": lines, "seq": seq}
+
+async def event_stream(since: int, job_id: Optional[str]):
+    """SSE: new log lines as they are written, progress at most every STREAM_PROGRESS_INTERVAL"""
+    loop = asyncio.get_running_loop()
+    waiter = (loop, asyncio.Event())
     with buffer_lock:
-        return {"logs": list(log_buffer)}
+        log_waiters.add(waiter)
+    try:
+        last_snapshot = None
+        last_progress = float("-inf")
+        last_sent = 0.0
+        while True:
+            lines, seq = logs_since(since)
+            if lines:
+                since = seq
+                yield f"id: {seq}\nevent: log\ndata: {json.dumps(lines)}\n\n"
+                last_sent = time.monotonic()
+            try:
+                progress = job_snapshot(job_id) if job_id else latest_job_snapshot()
+            except HTTPException:
+                progress = None
+            progress = progress or {"current": 0, "total": 0, "running": False}
+            # Log wake-ups don't bring progress with them; the one exception is a job that just finished
+            finished = bool(last_snapshot and last_snapshot["running"] and not progress["running"])
+            due = time.monotonic() - last_progress >= STREAM_PROGRESS_INTERVAL
+            if progress != last_snapshot and (due or finished):
+                last_snapshot = progress
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+                last_progress = last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > STREAM_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            waiter[1].clear()
+            remaining = last_progress + STREAM_PROGRESS_INTERVAL - time.monotonic()
+            try:
+                # Woken by new log lines; otherwise re-check progress when the interval is up
+                await asyncio.wait_for(waiter[1].wait(), timeout=remaining if remaining > 0 else STREAM_PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.sleep(STREAM_MIN_INTERVAL)  # Coalesce bursts of lines into one event
+    finally:
+        with buffer_lock:
+            log_waiters.discard(waiter)
+
+def metric_gauges():
+    """Gauges sampled at scrape time from jobs, dispatchers and the connection pool"""
+    dispatchers = [job.dispatcher for job in job_manager.active() if job.dispatcher]
+    dispatchers += list(refresh_scheduler.dispatchers.values())
+    in_flight = collections.Counter()
+    for dispatcher in dispatchers:
+        for url, window in dispatcher.windows.items():
+            in_flight[url] += window.in_flight
+    jobs = collections.Counter(job.status for job in job_manager.jobs.values())
+    active = job_manager.active()
+    pool = collections.Counter()
+    for key, conns in connection_pool._conns.items():
+        pool[f"{key[0]}:{key[1]}"] += len(conns)
+    return [
+        ("uia_inflight_batches", "Batches currently in flight", [({"agent": url}, n) for url, n in in_flight.items()]),
+        ("uia_pool_connections", "Open pooled connections", [({"agent": agent}, n) for agent, n in pool.items()]),
+        ("uia_jobs", "Jobs by status", [({"status": status}, n) for status, n in jobs.items()]),
+        ("uia_job_entries_sent", "Entries acknowledged so far, per active job",
+         [({"job_id": job.id, "kind": job.kind}, job.current) for job in active]),
+        ("uia_job_entries_total", "Entries to deliver, per active job",
+         [({"job_id": job.id, "kind": job.kind}, job.total) for job in active]),
+        ("uia_job_entries_failed", "Entries in dead-lettered batches, per active job",
+         [({"job_id": job.id, "kind": job.kind}, job.failed) for job in active]),
+        ("uia_pipeline_queue_depth", "Batches built ahead and waiting for the sender, per active job",
+         [({"job_id": job.id, "kind": job.kind}, job.pipeline.queue.qsize()) for job in active if job.pipeline]),
+        ("uia_payload_cache_bytes", "Bytes of built payloads in the payload cache",
+         [({}, payload_cache.bytes)] if payload_cache else []),
+        ("uia_job_rate_limit", "Current send rate limit (entries/sec), per active job",
+         [({"job_id": job.id, "kind": job.kind}, job.dispatcher.rate) for job in active
+          if job.dispatcher and job.dispatcher.rate]),
+        ("uia_mapping_state_entries", "Known mappings per agent",
+         [({"agent": url}, len(table)) for url, table in mapping_state.agents.items()]),
+    ]
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition"""
+    return PlainTextResponse(metrics.render(metric_gauges()), media_type="text/plain; version=0.0.4")
+
+@app.get("/events")
+async def stream_events(request: Request, since: int = 0, job_id: Optional[str] = None):
+    """Server-sent events: "log" (JSON list of new lines, id = sequence) and "progress" """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)  # Browser reconnect: carry on after the last line it saw
+    return StreamingResponse(event_stream(since, job_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def start_tag_job(target: str, source: str, fmt: str, options: dict) -> MappingJob:
+    request = TagJobRequest(target=target, source=source, format=fmt, **options)
+    try:
+        resolve_agents(request.uia_url, request.agent_group)
+    except ValueError as e:
+        os.remove(source)
+        raise HTTPException(status_code=400, detail=str(e))
+    return job_manager.submit("tags", request, process_tag_job)
+
+def tag_job_response(kind: str, job: MappingJob):
+    return {"message": f"{kind} update started in background.", "job_id": job.id}
 
 @app.post("/update-tags")
 async def update_tags(request: TagRequest):
+    if len(request.items) > max(1, request.batch_size):
+        logger.info(f"DUG update: {len(request.items)} users, action={request.action}, batched")
+        options = request.model_dump(exclude={"items"})
+        job = start_tag_job("user", spool_items(request.items), "ndjson", options)
+        return tag_job_response("DUG", job)
+    try:
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     logger.info(f"DUG update: {len(request.items)} users, action={request.action}")
-    uid_msg = create_tag_message(request.items, request.action)
-    xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
-    logger.info(f"Sending DUG XML to {request.uia_url}")
-    result = await send_payload_async(xml_str, request.cert_path, request.uia_url)
-    if "error" in result:
-        logger.error(f"DUG error: {result['error']}")
-        raise HTTPException(status_code=500, detail=result["error"])
-    logger.info("DUG update complete")
-    return result
+    logger.info(f"Sending DUG XML to {', '.join(agents)}")
+    results = await dispatch_items(agents, mode, request.items, lambda item, n: shard_for_user(item["user"], n),
+                                   build_tag_payload, request.action, request.cert_path)
+    return tag_update_response("DUG", results, single=not request.agent_group)
 
 @app.post("/update-ip-tags")
 async def update_ip_tags(request: IpTagRequest):
+    if len(request.items) > max(1, request.batch_size):
+        logger.info(f"DAG update: {len(request.items)} IPs, action={request.action}, batched")
+        options = request.model_dump(exclude={"items"})
+        job = start_tag_job("ip", spool_items(request.items), "ndjson", options)
+        return tag_job_response("DAG", job)
+    try:
+        agents, mode = resolve_agents(request.uia_url, request.agent_group)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     logger.info(f"DAG update: {len(request.items)} IPs, action={request.action}")
-    uid_msg = create_ip_tag_message(request.items, request.action)
-    xml_str = ET.tostring(uid_msg, encoding='utf-8', method='xml').decode()
-    logger.info(f"Sending DAG XML to {request.uia_url}")
-    result = await send_payload_async(xml_str, request.cert_path, request.uia_url)
-    if "error" in result:
-        logger.error(f"DAG error: {result['error']}")
-        raise HTTPException(status_code=500, detail=result["error"])
-    logger.info("DAG update complete")
-    return result
+    logger.info(f"Sending DAG XML to {', '.join(agents)}")
+    results = await dispatch_items(agents, mode, request.items, lambda item, n: shard_for_ip(item["ip"], n),
+                                   build_ip_tag_payload, request.action, request.cert_path)
+    return tag_update_response("DAG", results, single=not request.agent_group)
+
+async def stream_tag_upload(target: str, http_request: Request, fmt: Optional[str], options: dict):
+    """Spool an NDJSON/CSV body to disk as it arrives and hand it to a tag job"""
+    if fmt is None:
+        fmt = "csv" if "csv" in http_request.headers.get("content-type", "") else "ndjson"
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    source = await spool_upload(http_request.stream(), fmt)
+    kind = TAG_TARGETS[target][0]
+    logger.info(f"{kind} upload spooled: {os.path.getsize(source)} bytes, action={options['action']}")
+    return tag_job_response(kind, start_tag_job(target, source, fmt, options))
+
+@app.post("/update-tags/stream")
+async def update_tags_stream(http_request: Request, action: str, tag: Optional[str] = None,
+                             uia_url: Optional[str] = None, agent_group: Optional[str] = None,
+                             format: Optional[str] = None, batch_size: int = TAG_BATCH_SIZE,
+                             cert_path: str = "certs/uia-client-bundle.pem"):
+    """DUG update from a streamed body: NDJSON {"user", "tag"} lines or CSV with user,tag columns"""
+    options = {"action": action, "tag": tag, "uia_url": uia_url, "agent_group": agent_group,
+               "batch_size": batch_size, "cert_path": cert_path}
+    return await stream_tag_upload("user", http_request, format, options)
+
+@app.post("/update-ip-tags/stream")
+async def update_ip_tags_stream(http_request: Request, action: str, tag: Optional[str] = None,
+                                uia_url: Optional[str] = None, agent_group: Optional[str] = None,
+                                format: Optional[str] = None, batch_size: int = TAG_BATCH_SIZE,
+                                cert_path: str = "certs/uia-client-bundle.pem"):
+    """DAG update from a streamed body: NDJSON {"ip", "tag"} lines or CSV with ip,tag columns"""
+    options = {"action": action, "tag": tag, "uia_url": uia_url, "agent_group": agent_group,
+               "batch_size": batch_size, "cert_path": cert_path}
+    return await stream_tag_upload("ip", http_request, format, options)
+
+@app.get("/agent-groups")
+async def list_agent_groups():
+    load_shared_config()
+    return {"groups": list(agent_groups.values())}
+
+@app.post("/agent-groups")
+async def save_agent_group(request: AgentGroupRequest):
+    """Register (or replace) a named set of UIA Agents"""
+    if request.mode not in ("broadcast", "shard"):
+        raise HTTPException(status_code=400, detail="mode must be 'broadcast' or 'shard'")
+    if not request.agents:
+        raise HTTPException(status_code=400, detail="An agent group needs at least one agent")
+    bad = [url for url in request.agents if ':' not in url]
+    if bad:
+        raise HTTPException(status_code=400, detail=f"Invalid agent address (use host:port): {bad}")
+    load_shared_config()
+    agent_groups[request.name] = request
+    save_agent_groups()
+    logger.info(f"Agent group '{request.name}' saved: {len(request.agents)} agents, {request.mode}")
+    return {"message": f"Agent group '{request.name}' saved."}
+
+@app.delete("/agent-groups/{name}")
+async def delete_agent_group(name: str):
+    load_shared_config()
+    if agent_groups.pop(name, None) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown agent group: {name}")
+    save_agent_groups()
+    logger.info(f"Agent group '{name}' removed")
+    return {"message": f"Agent group '{name}' removed."}
 
 # Certificate Management
 import shutil
@@ -518,12 +3652,16 @@ from fastapi.responses import FileResponse
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
 from cryptography.hazmat.primitives.serialization import pkcs12
 
 CERT_DIR = os.environ.get("CERT_DIR", "certs")
 
-def generate_key():
+PKI_KEY_TYPES = ("rsa", "ecdsa")
+
+def generate_key(key_type: str = "rsa"):
+    if key_type == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1())  # Much cheaper to sign with, so cheaper handshakes
     return rsa.generate_private_key(public_exponent=65537, key_size=2048)
 
 @app.get("/cert-status")
@@ -542,15 +3680,27 @@ async def cert_status():
 
 class GeneratePKIRequest(BaseModel):
     password: str = "changeme"
+    key_type: str = "rsa"  # "rsa" (2048-bit) or "ecdsa" (P-256) for the CA, server and client keys
+    wait: bool = True  # False: answer at once with a job id to poll at /generate-pki/{job_id}
 
-@app.post("/generate-pki")
-async def generate_pki(request: GeneratePKIRequest):
-    """Generate full PKI: Root CA, Server Cert, Client Cert"""
-    logger.info("Generating fresh PKI...")
-    os.makedirs(CERT_DIR, exist_ok=True)
+pki_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="pki")  # One generation at a time
+pki_jobs = collections.OrderedDict()  # id -> status record
+pki_tasks = set()
+
+@contextlib.contextmanager
+def open_cert_file(cert_dir: str, name: str):
+    """Write a cert file next to its final path and swap it in, so connections never load a half-written file"""
+    path = os.path.join(cert_dir, name)
+    with open(path + ".tmp", "wb") as f:
+        yield f
+    os.replace(path + ".tmp", path)
+
+def write_pki(cert_dir: str, password: str, key_type: str):
+    """Root CA, server bundle (for the UIA Agent) and client cert (for this app); blocking, run in pki_executor"""
+    os.makedirs(cert_dir, exist_ok=True)
     
     # Root CA
-    ca_key = generate_key()
+    ca_key = generate_key(key_type)
     ca_subject = x509.Name([
         x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
         x509.NameAttribute(NameOID.ORGANIZATION_NAME, "UIA-App"),
@@ -567,13 +3717,13 @@ async def generate_pki(request: GeneratePKIRequest):
     ).sign(ca_key, hashes.SHA256())
     
     # Save Root CA
-    with open(os.path.join(CERT_DIR, "rootCA.key"), "wb") as f:
+    with open_cert_file(cert_dir, "rootCA.key") as f:
         f.write(ca_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
-    with open(os.path.join(CERT_DIR, "rootCA.crt"), "wb") as f:
+    with open_cert_file(cert_dir, "rootCA.crt") as f:
         f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
     
     # Server Cert (for UIA Agent)
-    srv_key = generate_key()
+    srv_key = generate_key(key_type)
     srv_subject = x509.Name([
         x509.NameAttribute(NameOID.ORGANIZATION_NAME, "UIA-App"),
         x509.NameAttribute(NameOID.COMMON_NAME, "uia-server"),
@@ -589,12 +3739,12 @@ async def generate_pki(request: GeneratePKIRequest):
     ).sign(ca_key, hashes.SHA256())
     
     # Save Server Cert as encrypted PEM bundle (key + cert + CA in one file)
-    with open(os.path.join(CERT_DIR, "uia-server-bundle.pem"), "wb") as f:
+    with open_cert_file(cert_dir, "uia-server-bundle.pem") as f:
         # Encrypted private key
         f.write(srv_key.private_bytes(
             serialization.Encoding.PEM,
             serialization.PrivateFormat.PKCS8,
-            serialization.BestAvailableEncryption(request.password.encode())
+            serialization.BestAvailableEncryption(password.encode())
         ))
         # Server cert
         f.write(srv_cert.public_bytes(serialization.Encoding.PEM))
@@ -602,7 +3752,7 @@ async def generate_pki(request: GeneratePKIRequest):
         f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
     
     # Client Cert (for this app) - unencrypted for internal use
-    cli_key = generate_key()
+    cli_key = generate_key(key_type)
     cli_subject = x509.Name([
         x509.NameAttribute(NameOID.ORGANIZATION_NAME, "UIA-App"),
         x509.NameAttribute(NameOID.COMMON_NAME, "uia-client"),
@@ -618,13 +3768,57 @@ async def generate_pki(request: GeneratePKIRequest):
     ).sign(ca_key, hashes.SHA256())
     
     # Save Client Cert (unencrypted for internal app use)
-    with open(os.path.join(CERT_DIR, "uia-client.key"), "wb") as f:
+    with open_cert_file(cert_dir, "uia-client.key") as f:
         f.write(cli_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
-    with open(os.path.join(CERT_DIR, "uia-client.crt"), "wb") as f:
+    with open_cert_file(cert_dir, "uia-client.crt") as f:
         f.write(cli_cert.public_bytes(serialization.Encoding.PEM))
-    
-    logger.info("PKI generation complete")
-    return {"message": "PKI generated successfully", "password": request.password}
+
+def save_pki_job(record: dict):
+    pki_jobs[record["id"]] = record
+    while len(pki_jobs) > JOB_HISTORY:
+        pki_jobs.popitem(last=False)
+    state_store.set_config(f"pki_job:{record['id']}", record)
+
+async def run_pki_job(record: dict, request: GeneratePKIRequest):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(pki_executor, write_pki, CERT_DIR, request.password, request.key_type)
+    except Exception as e:
+        record.update(status="failed", error=str(e))
+        logger.error(f"[{record['id']}] PKI generation failed: {e}")
+    else:
+        invalidate_ssl_contexts()
+        record["status"] = "completed"
+        logger.info(f"[{record['id']}] PKI generation complete")
+    record["finished"] = datetime.now().isoformat(timespec="seconds")
+    save_pki_job(record)
+
+@app.post("/generate-pki")
+async def generate_pki(request: GeneratePKIRequest):
+    """Generate full PKI: Root CA, Server Cert, Client Cert (in a worker thread; the event loop keeps serving)"""
+    if request.key_type not in PKI_KEY_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown key_type: {request.key_type}. Use {', '.join(PKI_KEY_TYPES)}")
+    record = {"id": uuid.uuid4().hex[:12], "status": "running", "key_type": request.key_type,
+              "started": datetime.now().isoformat(timespec="seconds"), "finished": None, "error": None}
+    save_pki_job(record)
+    logger.info(f"[{record['id']}] Generating fresh PKI ({request.key_type})...")
+    task = asyncio.create_task(run_pki_job(record, request))
+    pki_tasks.add(task)
+    task.add_done_callback(pki_tasks.discard)
+    if not request.wait:
+        return {"message": "PKI generation started", "job_id": record["id"], "status": "running"}
+    await asyncio.shield(task)  # A dropped client doesn't stop the generation
+    if record["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"PKI generation failed: {record['error']}")
+    return {"message": "PKI generated successfully", "password": request.password, "job_id": record["id"],
+            "key_type": request.key_type}
+
+@app.get("/generate-pki/{job_id}")
+async def get_pki_job(job_id: str):
+    record = pki_jobs.get(job_id) or state_store.get_config(f"pki_job:{job_id}")
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Unknown PKI job: {job_id}")
+    return record
 
 @app.post("/upload-certs")
 async def upload_certs(
@@ -644,6 +3838,7 @@ async def upload_certs(
     with open(os.path.join(CERT_DIR, "rootCA.crt"), "wb") as f:
         f.write(await root_ca.read())
     
+    invalidate_ssl_contexts()
     logger.info("Custom certificates uploaded successfully")
     return {"message": "Certificates uploaded successfully"}
 
@@ -683,4 +3878,5 @@ async def spa_fallback(full_path: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Several workers need an import string so each process loads its own app
+    uvicorn.run("main:app" if WORKERS > 1 else app, host="0.0.0.0", port=8000, workers=WORKERS)
@@ -0,0 +1,237 @@
+"""
+Local stand-in for the Windows User-ID Agent XML API, for load and fault testing.
+
+Serves the uid-message protocol over mTLS using the certificates from
+/generate-pki (or generate_certs.py):
+
+    python uia_simulator.py --password changeme
+    python uia_simulator.py --latency 20 --max-eps 5000 --error-rate 0.01
+
+Then point the app at 127.0.0.1:5006.
+"""
+import os
+import ssl
+import time
+import socket
+import random
+import asyncio
+import argparse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+AGENT_VERSION = "11.0.0-sim"
+
+def ok_body(result: str = "") -> bytes:
+    return f"<uid-response><version>1.0</version><result>{result}</result></uid-response>".encode()
+
+def error_body(message: str) -> bytes:
+    return f"<uid-response status=\"error\"><version>1.0</version><result>{message}</result></uid-response>".encode()
+
+def rejected_body(rejected) -> bytes:
+    """Per-entry rejections: the other entries of the message were applied"""
+    sections = {}
+    for action, entry in rejected:
+        attrs = "".join(f' {key}="{escape(value, {chr(34): "&quot;"})}"' for key, value in entry.attrib.items()
+                        if key in ("ip", "name", "user"))
+        sections.setdefault(action, []).append(f'<entry{attrs} message="Simulated rejection"/>')
+    payload = "".join(f"<{action}>{''.join(entries)}</{action}>" for action, entries in sections.items())
+    return (f"<uid-response status=\"error\"><version>1.0</version><payload>{payload}</payload>"
+            f"</uid-response>").encode()
+
+class TokenBucket:
+    """Caps the entries/sec the simulated agent accepts; requests wait for capacity"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self, count: int):
+        if not self.rate:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.entries = 0
+        self.errors = 0
+        self.resets = 0
+        self.rejected = 0
+        self.connections = 0
+        self.by_type = {}  # "login", "logout", "register", ... -> entries
+
+class AgentSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.bucket = TokenBucket(args.max_eps)
+        self.ssl_context = self.make_ssl_context()
+
+    def make_ssl_context(self):
+        cert_dir = self.args.cert_dir
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        bundle = self.args.bundle or os.path.join(cert_dir, "uia-server-bundle.pem")
+        ctx.load_cert_chain(bundle, password=self.args.password or None)
+        if not self.args.no_client_auth:
+            ctx.load_verify_locations(os.path.join(cert_dir, "rootCA.crt"))
+            ctx.verify_mode = ssl.CERT_REQUIRED
+        return ctx
+
+    def handle_message(self, body: bytes):
+        """Returns (body, entry count) for one uid-message"""
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError as e:
+            return error_body(f"Malformed XML: {e}"), 0
+        payload = root.find("payload")
+        if payload is None or len(payload) == 0:
+            return error_body("Missing payload"), 0
+        if root.findtext("type") == "op":
+            if payload.find("show/version") is not None:
+                return ok_body(f"<version>{AGENT_VERSION}</version>"), 0
+            return error_body("Unsupported op command"), 0
+        count = 0
+        rejected = []
+        for section in payload:
+            entries = section.findall("entry")
+            if self.args.reject_rate:
+                rejected += [(section.tag, entry) for entry in entries if random.random() < self.args.reject_rate]
+            self.stats.by_type[section.tag] = self.stats.by_type.get(section.tag, 0) + len(entries)
+            count += len(entries)
+        if rejected:
+            self.stats.rejected += len(rejected)
+            return rejected_body(rejected), count - len(rejected)
+        return ok_body(), count
+
+    async def respond(self, body: bytes):
+        """Returns (status, reason, body), or None to reset the connection"""
+        args = self.args
+        if random.random() < args.reset_rate:
+            return None
+        reply, count = self.handle_message(body)
+        await self.bucket.take(count)
+        delay = args.latency + random.uniform(0, args.jitter) + count * args.entry_latency / 1000
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if random.random() < args.http_error_rate:
+            return 503, "Service Unavailable", b"Agent busy"
+        if random.random() < args.error_rate:
+            return 200, "OK", error_body("Simulated agent failure")
+        self.stats.entries += count
+        return 200, "OK", reply
+
+    async def accept(self, sock):
+        """TLS handshake on an accepted socket, after the configured delay, then serve it"""
+        loop = asyncio.get_running_loop()
+        self.stats.connections += 1
+        if self.args.handshake_delay:
+            # The ClientHello waits in the socket buffer meanwhile
+            await asyncio.sleep(self.args.handshake_delay / 1000)
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        try:
+            transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock, ssl=self.ssl_context)
+        except (ssl.SSLError, ConnectionError) as e:
+            print(f"Handshake failed: {e}", flush=True)
+            sock.close()
+            return
+        await self.handle_connection(reader, asyncio.StreamWriter(transport, protocol, reader, loop))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.stats.requests += 1
+                response = await self.respond(body)
+                if response is None:
+                    self.stats.resets += 1
+                    writer.transport.abort()
+                    return
+                status, reason, reply = response
+                if status != 200 or reply.startswith(b'<uid-response status="error"><version>1.0</version><result>'):
+                    self.stats.errors += 1
+                writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/xml\r\n"
+                             f"Content-Length: {len(reply)}\r\n\r\n".encode() + reply)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ssl.SSLError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def report(self):
+        last_entries, last_time = 0, time.monotonic()
+        while True:
+            await asyncio.sleep(self.args.stats_interval)
+            now = time.monotonic()
+            s = self.stats
+            rate = (s.entries - last_entries) / (now - last_time)
+            last_entries, last_time = s.entries, now
+            print(f"requests={s.requests} entries={s.entries} ({rate:.0f}/s) errors={s.errors} "
+                  f"resets={s.resets} rejected={s.rejected} connections={s.connections} {s.by_type}", flush=True)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        listener = socket.create_server((self.args.host, self.args.port), backlog=512)
+        listener.setblocking(False)
+        print(f"UIA Agent simulator listening on {self.args.host}:{self.args.port}", flush=True)
+        reporter = asyncio.create_task(self.report()) if self.args.stats_interval else None
+        connections = set()
+        with listener:
+            while True:
+                sock, _ = await loop.sock_accept(listener)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                task = asyncio.create_task(self.accept(sock))
+                connections.add(task)
+                task.add_done_callback(connections.discard)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local UIA Agent stand-in for load and fault testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5006)
+    parser.add_argument("--cert-dir", default=os.environ.get("CERT_DIR", "certs"))
+    parser.add_argument("--bundle", help="Server key + cert PEM (default: <cert-dir>/uia-server-bundle.pem)")
+    parser.add_argument("--password", default=os.environ.get("SIM_BUNDLE_PASSWORD", ""),
+                        help="Password of the bundle's private key (the one given to /generate-pki)")
+    parser.add_argument("--no-client-auth", action="store_true", help="Accept clients without a certificate")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="Up to this many extra milliseconds, at random")
+    parser.add_argument("--entry-latency", type=float, default=0, help="Microseconds added per entry")
+    parser.add_argument("--max-eps", type=float, default=0, help="Entries/sec the agent accepts (0: no cap)")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered status='error'")
+    parser.add_argument("--http-error-rate", type=float, default=0, help="Fraction of requests answered HTTP 503")
+    parser.add_argument("--reject-rate", type=float, default=0,
+                        help="Fraction of entries rejected individually (the rest of the message is applied)")
+    parser.add_argument("--reset-rate", type=float, default=0, help="Fraction of requests answered with a reset")
+    parser.add_argument("--handshake-delay", type=float, default=0, help="Milliseconds before each TLS handshake")
+    parser.add_argument("--stats-interval", type=float, default=5, help="Seconds between stats lines (0: off)")
+    return parser.parse_args(argv)
+
+def main():
+    simulator = AgentSimulator(parse_args())
+    try:
+        asyncio.run(simulator.serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()